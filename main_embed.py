@@ -1,14 +1,29 @@
 import argparse
+import glob
+import math
+import multiprocessing
 import os
-from typing import Optional
+import queue
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from typing import Any, Callable, Iterable, Optional
 import xml.etree.ElementTree as ElementTree
 
 import torch
-from rdflib import Graph
 from tqdm import tqdm
+from transformers import BertTokenizerFast
 
-from model import EmbeddingsLayer
-from utils import download_from_url, EmbeddingsDataset
+from model import EmbeddingsLayer, OntologyIndex, TokenizationCache
+from model.bert_encoder import ATTENTION_BACKENDS
+from model.embeddings_layer import DEFAULT_MODEL_NAME
+from utils import download_from_url, EmbeddingsDataset, composite_languages, EmbeddingsStore, EmbeddingsStoreWriter, \
+    convert_embeddings_dir, merge_stores, merge_views, write_view, ContentAddressedStore, opinion_key, PRECISIONS
+
+
+CONTENT_STORE_DIR = "data/embeddings/cache"
+"""The ContentAddressedStore that contains all generated embeddings"""
 
 
 def get_data(year, phase, language, dirname):
@@ -20,44 +35,350 @@ def get_data(year, phase, language, dirname):
 
     return tree
 
-def generate_embeddings(embeddings_layer: EmbeddingsLayer, data: ElementTree, embeddings_dir: str):
-    os.makedirs(embeddings_dir, exist_ok=True)
-    print(f"\nGenerating embeddings into {embeddings_dir}")
+Opinion = tuple[str, int, int, int, Optional[str]]
+"""The sentence, the start and end character index of the target, the label and the id of the sentence of an
+opinion"""
 
+
+def read_opinions(data: ElementTree) -> list[list[Opinion]]:
+    """Returns the opinions of each sentence in data."""
     labels = {
         'negative': 0,
         'neutral': 1,
         'positive': 2,
     }
 
-    with torch.no_grad():
-        i = 0
-        for node in tqdm(data.findall('.//sentence'), unit='sentence'):
-            sentence = node.find('./text').text
+    sentences: list[list[Opinion]] = []
+    for node in data.findall('.//sentence'):
+        sentence = node.find('./text').text
+        sentence_id = node.attrib.get('id')
+        opinions: list[Opinion] = []
+
+        for opinion in node.findall('.//Opinion'):
+            target_from = int(opinion.attrib['from'])
+            target_to = int(opinion.attrib['to'])
+            polarity = opinion.attrib['polarity']
+
+            if polarity not in labels:
+                raise ValueError(f"Unknown polarity \"{polarity}\" found at sentence \"{sentence}\"")
+
+            opinions.append((sentence, target_from, target_to, labels.get(polarity), sentence_id))
+
+        sentences.append(opinions)
+
+    return sentences
+
+
+def generate_embeddings(embeddings_layer: EmbeddingsLayer, data: ElementTree, embeddings_dir: str,
+                        precision='float32', config: Optional[dict] = None, batch_size=8):
+    """Generate the embeddings of all opinions in data. The opinions are encoded in batches of (at least) batch_size
+    opinions, the opinions of a sentence are always in the same batch. The configuration of the embeddings layer and
+    the given config are stored in the manifest of the embeddings."""
+    generate_embedding_variants(embeddings_layer, data,
+                                {(embeddings_layer.use_vm, embeddings_layer.use_soft_pos): embeddings_dir}, precision,
+                                config, batch_size)
+
+
+def generate_embedding_variants(embeddings_layer: EmbeddingsLayer, data: ElementTree,
+                                embeddings_dirs: dict[tuple[bool, bool], str], precision='float32',
+                                config: Optional[dict] = None, batch_size=8,
+                                content_store: Optional[ContentAddressedStore] = None):
+    """Generate the embeddings of all opinions in data for multiple combinations of use_vm and use_soft_pos, the
+    sentence trees are built once for all variants.
+
+    :param embeddings_dirs: the embeddings directory of each (use_vm, use_soft_pos) variant
+    """
+    for embeddings_dir in embeddings_dirs.values():
+        print(f"\nGenerating embeddings into {embeddings_dir}")
+
+    write_embedding_variants(embeddings_layer, read_opinions(data), embeddings_dirs, precision, config, batch_size,
+                             content_store=content_store)
+
+
+def write_embedding_variants(embeddings_layer: EmbeddingsLayer, sentences: list[list[Opinion]],
+                             embeddings_dirs: dict[tuple[bool, bool], str], precision='float32',
+                             config: Optional[dict] = None, batch_size=8, progress=True, queue_size=4,
+                             content_store: Optional[ContentAddressedStore] = None):
+    """Generate the embeddings of the opinions of the given sentences, see generate_embedding_variants. The
+    generation is pipelined: a thread tokenizes the sentences and builds the sentence trees ahead of the encoder, and
+    another thread writes the embeddings, the bounded queues between the stages hold at most queue_size batches.
+
+    :param queue_size: the maximum number of batches between two stages, 0 disables the pipeline
+    :param content_store: if given, the embeddings are added to this store and only the opinions that are not in the
+                          store yet are encoded, the embeddings directories become views of the store
+    """
+    variants = list(embeddings_dirs)
+    config = {
+        'ont_hops': embeddings_layer.ont_hops,
+        'model_name': embeddings_layer.model_name,
+        'max_knowledge_tokens': embeddings_layer.max_knowledge_tokens,
+        'max_target_knowledge_tokens': embeddings_layer.max_target_knowledge_tokens,
+        **(config if config is not None else {})
+    }
+    variant_configs = [{**config, 'use_vm': use_vm, 'use_soft_pos': use_soft_pos} for use_vm, use_soft_pos in variants]
+    encoder_id = embeddings_layer.encoder_id
+
+    def batches():
+        """Yields the opinions and the label and sentence id of each opinion, in batches of at least batch_size
+        opinions. All opinions of a sentence are in the same batch, such that the sentence can be encoded only once."""
+        batch: list[tuple[str, int, int]] = []
+        batch_info: list[tuple[int, Optional[str]]] = []
+
+        for opinions in tqdm(sentences, unit='sentence', disable=not progress):
+            for sentence, target_from, target_to, label, sentence_id in opinions:
+                batch.append((sentence, target_from, target_to))
+                batch_info.append((label, sentence_id))
+
+            if len(batch) >= batch_size:
+                yield batch, batch_info
+                batch, batch_info = [], []
+
+        if len(batch) > 0:
+            yield batch, batch_info
+
+    def prepare(batch: list[tuple[str, int, int]], batch_info: list[tuple[int, Optional[str]]]):
+        """Prepare the opinions of the batch that are not in the content store yet."""
+        keys: Optional[list[list[str]]] = None
+        missing = list(range(len(batch)))
+        if content_store is not None:
+            keys = [
+                [opinion_key(sentence, target_from, target_to, encoder_id, embeddings_layer.ont_hops, use_vm,
+                             use_soft_pos, precision) for use_vm, use_soft_pos in variants]
+                for sentence, target_from, target_to in batch
+            ]
+            missing = [i for i in missing if any(key not in content_store for key in keys[i])]
+
+        prepared = embeddings_layer.prepare_variants([batch[i] for i in missing], variants) if len(missing) > 0 \
+            else None
+        return batch_info, keys, missing, prepared
+
+    def process(item):
+        batch_info, keys, missing, prepared = item
+        results = embeddings_layer.encode_prepared(prepared) if prepared is not None else [[] for _ in variants]
+        return batch_info, keys, missing, results
+
+    # without a content store, the embeddings are written directly to the embeddings directories
+    rows: list[list[tuple[str, int]]] = [[] for _ in variants]
+    labels: list[int] = []
+    sentence_ids: list[Optional[str]] = []
+    n_encoded = 0
+
+    with torch.no_grad(), ExitStack() as stack:
+        writers = [
+            stack.enter_context(EmbeddingsStoreWriter(embeddings_dirs[variant],
+                                                      embedding_size=embeddings_layer.model.config.hidden_size,
+                                                      precision=precision, config=variant_config))
+            for variant, variant_config in zip(variants, variant_configs)
+        ] if content_store is None else []
+
+        def write(item):
+            nonlocal n_encoded
+            batch_info, keys, missing, results = item
+            n_encoded += len(missing)
+
+            if content_store is None:
+                for writer, variant_results in zip(writers, results):
+                    for (label, sentence_id), (embeddings, target_pos, hops) in zip(batch_info, variant_results):
+                        writer.append(embeddings, label, target_pos, hops, sentence_id)
+                return
+
+            for j, variant_results in enumerate(results):
+                for i, (embeddings, target_pos, hops) in zip(missing, variant_results):
+                    label, sentence_id = batch_info[i]
+                    content_store.put(keys[i][j], embeddings, label, target_pos, hops, sentence_id)
+            for i, (label, sentence_id) in enumerate(batch_info):
+                for j in range(len(variants)):
+                    rows[j].append(content_store.location(keys[i][j]))
+                labels.append(label)
+                sentence_ids.append(sentence_id)
+
+        if queue_size <= 0:
+            for batch, batch_info in batches():
+                write(process(prepare(batch, batch_info)))
+        else:
+            run_pipeline(
+                produce=lambda: (prepare(batch, batch_info) for batch, batch_info in batches()),
+                process=process,
+                consume=write,
+                queue_size=queue_size
+            )
+
+    if content_store is not None:
+        content_store.flush()
+        for j, variant in enumerate(variants):
+            write_view(embeddings_dirs[variant], rows[j], labels, sentence_ids, variant_configs[j])
+
+    n_opinions = sum(len(opinions) for opinions in sentences)
+    print(f"Generated embeddings for {n_opinions} opinions, {n_encoded} opinions were encoded")
+    embeddings_layer.tokenization_cache.save()
+    if embeddings_layer.injects_knowledge():
+        stats = embeddings_layer.knowledge_stats
+        print(f"Inserted {stats['inserted_tokens']} knowledge tokens, pruned {stats['pruned_tokens']} tokens "
+              f"({stats['pruned_nodes']} nodes) in {stats['pruned_sentences']} of {stats['sentences']} sentences")
+
+
+def run_pipeline(produce: Callable[[], Iterable[Any]], process: Callable[[Any], Any], consume: Callable[[Any], None],
+                 queue_size=4):
+    """Run a pipeline of three stages: the items of produce are created in a separate thread, they are processed by
+    process in the calling thread, and the results are passed to consume in another thread. The stages are connected
+    by queues of at most queue_size items. If a stage fails, the remaining items are drained and the first error is
+    raised once all threads have stopped."""
+    produced: queue.Queue = queue.Queue(maxsize=queue_size)
+    processed: queue.Queue = queue.Queue(maxsize=queue_size)
+    errors: list[BaseException] = []
+    stop = threading.Event()
+    end = object()
+
+    def producer():
+        try:
+            for item in produce():
+                if stop.is_set():
+                    break
+                produced.put(item)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            produced.put(end)
+
+    def consumer():
+        while (item := processed.get()) is not end:
+            if stop.is_set():
+                continue
+            try:
+                consume(item)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+    threads = [threading.Thread(target=producer, daemon=True), threading.Thread(target=consumer, daemon=True)]
+    for thread in threads:
+        thread.start()
+
+    while (item := produced.get()) is not end:
+        if stop.is_set():
+            continue
+        try:
+            processed.put(process(item))
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    processed.put(end)
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0]
+
+
+def generate_shard(layer_args: dict, sentences: list[list[Opinion]], embeddings_dirs: dict[tuple[bool, bool], str],
+                   precision: str, config: Optional[dict], batch_size: int, n_threads: Optional[int],
+                   content_store_path: Optional[str] = None):
+    """Generate the embeddings of a shard of the sentences in a worker process, see generate_embeddings_parallel."""
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    torch.set_default_device(layer_args.get('device', 'cpu'))
+
+    # the tokenization cache is filled and saved by the main process
+    if layer_args.get('tokenization_cache') is not None:
+        layer_args['tokenization_cache'].path = None
+
+    content_store = ContentAddressedStore(content_store_path, precision) if content_store_path is not None else None
+    write_embedding_variants(EmbeddingsLayer(**layer_args), sentences, embeddings_dirs, precision, config, batch_size,
+                             progress=False, content_store=content_store)
+
+
+def generate_embeddings_parallel(layer_args: dict, data: ElementTree, embeddings_dirs: dict[tuple[bool, bool], str],
+                                 precision='float32', config: Optional[dict] = None, batch_size=8, n_workers=2,
+                                 n_threads: Optional[int] = None, content_store_path: Optional[str] = None):
+    """Generate the embeddings of all opinions in data using n_workers processes, each with its own EmbeddingsLayer
+    and n_threads threads. Every worker encodes a contiguous shard of the sentences into a separate store, the stores
+    are merged in order, such that the opinions are in the same order as in data.
+
+    :param layer_args: the keyword arguments of the EmbeddingsLayer of each worker
+    :param content_store_path: the path of the ContentAddressedStore that is shared by the workers, the shards are
+                               then views of the store
+    """
+    for embeddings_dir in embeddings_dirs.values():
+        print(f"\nGenerating embeddings into {embeddings_dir} using {n_workers} workers")
+
+    sentences = read_opinions(data)
+
+    # the workers only read the tokenization cache, so all sentences are tokenized once before the workers start
+    tokenization_cache: Optional[TokenizationCache] = layer_args.get('tokenization_cache')
+    if tokenization_cache is not None:
+        tokenizer = BertTokenizerFast.from_pretrained(layer_args.get('model_name', DEFAULT_MODEL_NAME))
+        tokenization_cache.tokenize([opinion[0] for opinions in sentences for opinion in opinions], tokenizer)
+        tokenization_cache.save()
+
+    shard_size = max(1, math.ceil(len(sentences) / n_workers))
+    shards = [sentences[i:i + shard_size] for i in range(0, len(sentences), shard_size)]
+    shard_dirs = [
+        {variant: f"{embeddings_dir}.shards/{k}" for variant, embeddings_dir in embeddings_dirs.items()}
+        for k in range(len(shards))
+    ]
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [
+                executor.submit(generate_shard, layer_args, shard, dirs, precision, config, batch_size, n_threads,
+                                content_store_path)
+                for shard, dirs in zip(shards, shard_dirs)
+            ]
+            for future in futures:
+                future.result()
+
+        for variant, embeddings_dir in embeddings_dirs.items():
+            merge = merge_views if content_store_path is not None else merge_stores
+            n = merge([dirs[variant] for dirs in shard_dirs], embeddings_dir)
+            print(f"Merged {len(shard_dirs)} shards with {n} opinions into {embeddings_dir}")
+    finally:
+        # the shards are removed even if a worker failed, a new run generates them again
+        for embeddings_dir in embeddings_dirs.values():
+            shutil.rmtree(f"{embeddings_dir}.shards", ignore_errors=True)
+
+
+def run_generation(layer_args: dict, data: ElementTree, embeddings_dirs: dict[tuple[bool, bool], str],
+                   precision='float32', config: Optional[dict] = None, batch_size=8, n_workers=1,
+                   n_threads: Optional[int] = None, content_store_path: Optional[str] = None):
+    """Generate the embeddings in this process, or in n_workers processes if n_workers > 1.
+
+    :param content_store_path: the path of a ContentAddressedStore, the embeddings that are in this store are not
+                               generated again
+    """
+    # a dataset with fewer sentences than workers is not worth starting the workers for
+    if n_workers > 1 and len(data.findall('.//sentence')) >= n_workers:
+        generate_embeddings_parallel(layer_args, data, embeddings_dirs, precision, config, batch_size, n_workers,
+                                     n_threads, content_store_path)
+        return
+
+    content_store = ContentAddressedStore(content_store_path, precision) if content_store_path is not None else None
+    generate_embedding_variants(EmbeddingsLayer(**layer_args), data, embeddings_dirs, precision, config, batch_size,
+                                content_store)
 
-            for opinion in node.findall('.//Opinion'):
-                target_from = int(opinion.attrib['from'])
-                target_to = int(opinion.attrib['to'])
-                polarity = opinion.attrib['polarity']
 
-                if polarity not in labels:
-                    raise ValueError(f"Unknown polarity \"{polarity}\" found at sentence \"{sentence}\"")
+def convert_all_embeddings(root_dir="data/embeddings"):
+    """Convert all embedding directories with one .pt file per opinion into an EmbeddingsStore."""
+    for path in sorted(glob.glob(f"{root_dir}/*")):
+        if not os.path.isdir(path) or EmbeddingsStore.exists(path) or len(glob.glob(f"{path}/*.pt")) == 0:
+            continue
 
-                label = labels.get(polarity)
+        print(f"Converting {path}")
+        n = convert_embeddings_dir(path)
+        print(f"Converted {n} opinions")
 
-                embeddings, target_pos, hops = embeddings_layer.forward(sentence, target_from, target_to)
-                data = {'label': label, 'embeddings': embeddings, 'target_pos': target_pos, 'hops': hops}
-                torch.save(data, f"{embeddings_dir}/{i}.pt")
-                i += 1
 
-        print(f"Generated embeddings for {i} opinions")
+def load_tokenization_cache(dirname: str):
+    """Load the tokenized sentences of the data in data/{dirname}, which are shared by all runs."""
+    return TokenizationCache(f"data/cache/tokenized_{dirname}.pkl")
 
 
 def load_ontology():
     path = download_from_url(
         url="https://raw.githubusercontent.com/KSchouten/Heracles/master/src/main/resources/externalData/ontology.owl-Expanded.owl",
         path="Data/raw/ontology.owl-Extended.owl")
-    return Graph().parse(path)
+    return OntologyIndex.from_owl(path)
 
 
 def main():
@@ -75,8 +396,43 @@ def main():
                         help="Whether to use soft positions")
     parser.add_argument("--all", default=False, type=bool, action=argparse.BooleanOptionalAction,
                         help="Generate all embeddings for a given year")
+    parser.add_argument("--batch-size", default=8, type=int,
+                        help="The minimum number of opinions that are encoded at once")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="The number of processes that generate the embeddings, each process encodes a part of "
+                             "the sentences")
+    parser.add_argument("--threads-per-worker", default=None, type=int, required=False,
+                        help="The number of threads of each worker, defaults to the number of CPUs divided by the "
+                             "number of workers")
+    parser.add_argument("--model", default=DEFAULT_MODEL_NAME, type=str,
+                        help="The name of the pretrained BERT model that is used to generate the embeddings")
+    parser.add_argument("--attention", default="manual", choices=ATTENTION_BACKENDS,
+                        help="The implementation of the self-attention in the encoder")
+    parser.add_argument("--precision", default="float32", choices=list(PRECISIONS),
+                        help="The storage type of the embeddings, float16 and int8 reduce the size of the embeddings")
+    parser.add_argument("--max-knowledge-tokens", default=None, type=int, required=False,
+                        help="The maximum number of knowledge tokens that are inserted into a sentence")
+    parser.add_argument("--max-target-knowledge-tokens", default=None, type=int, required=False,
+                        help="The maximum number of knowledge tokens that are inserted for a single target word")
+    parser.add_argument("--embeddings-cache", default=True, type=bool, action=argparse.BooleanOptionalAction,
+                        help=f"Keep all generated embeddings in {CONTENT_STORE_DIR}, such that embeddings that were "
+                             f"generated before, e.g., by an interrupted run, are not generated again")
+    parser.add_argument("--clean-embeddings-cache", default=False, type=bool, action=argparse.BooleanOptionalAction,
+                        help=f"Remove the incomplete embeddings of interrupted runs from {CONTENT_STORE_DIR}, only use "
+                             f"this when no other run is generating embeddings")
+    parser.add_argument("--convert", default=False, type=bool, action=argparse.BooleanOptionalAction,
+                        help="Convert all existing embeddings with one file per opinion into a single packed file")
     args = parser.parse_args()
 
+    if args.clean_embeddings_cache:
+        n_removed = ContentAddressedStore.remove_incomplete(CONTENT_STORE_DIR)
+        print(f"Removed {n_removed} incomplete chunks from {CONTENT_STORE_DIR}")
+        return
+
+    if args.convert:
+        convert_all_embeddings()
+        return
+
     year: int = args.year
     phase: str = args.phase
     language: str = args.language
@@ -85,6 +441,17 @@ def main():
     use_vm: bool = args.vm
     use_soft_pos: bool = args.sp
     generate_all: bool = args.all
+    precision: str = args.precision
+    batch_size: int = args.batch_size
+    attention_backend: str = args.attention
+    model_name: str = args.model
+    n_workers: int = args.workers
+    content_store_path: Optional[str] = CONTENT_STORE_DIR if args.embeddings_cache else None
+    n_threads: Optional[int] = args.threads_per_worker
+    if n_workers > 1 and n_threads is None:
+        n_threads = max((os.cpu_count() or 1) // n_workers, 1)
+    max_knowledge_tokens: Optional[int] = args.max_knowledge_tokens
+    max_target_knowledge_tokens: Optional[int] = args.max_target_knowledge_tokens
 
     if ont_hops is None and (use_vm is False or use_soft_pos is False):
         raise ValueError("The visible matrix and soft positions have no effect without hops in the ontology")
@@ -93,22 +460,35 @@ def main():
                           'mps' if torch.backends.mps.is_available() else 'cpu')
     torch.set_default_device(device)
 
+    tokenization_cache = load_tokenization_cache(dirname)
+
     # generate embeddings only for selected options
     if not generate_all:
+        # composite languages are views over the embeddings of their components, which are not encoded again
+        if composite_languages(language) is not None:
+            dataset = EmbeddingsDataset(year=year, device=device, phase=phase, language=language, ont_hops=ont_hops,
+                                        use_vm=use_vm, use_soft_pos=use_soft_pos, precision=precision)
+            print(f"{dataset.dir} contains {len(dataset)} opinions of {', '.join(dataset.components)}")
+            return
+
         data = get_data(year, phase, language, dirname)
 
 
         # load ontology
-        ontology: Graph | None = None
+        ontology: OntologyIndex | None = None
         if ont_hops is not None and ont_hops >= 0:
             print(f"Loading ontology to include {ont_hops} hops")
             ontology = load_ontology()
 
-        embeddings_layer = EmbeddingsLayer(hops=ont_hops, ontology=ontology, use_vm=use_vm, use_soft_pos=use_soft_pos,
-                                           device=device)
+        layer_args = dict(hops=ont_hops, ontology=ontology, use_vm=use_vm, use_soft_pos=use_soft_pos, device=device,
+                          attention_backend=attention_backend, tokenization_cache=tokenization_cache,
+                          model_name=model_name, max_knowledge_tokens=max_knowledge_tokens,
+                          max_target_knowledge_tokens=max_target_knowledge_tokens)
         embeddings_dir = EmbeddingsDataset(year=year, device=device, phase=phase, language=language, ont_hops=ont_hops, empty_ok=True,
-                                           use_vm=use_vm, use_soft_pos=use_soft_pos).dir
-        generate_embeddings(embeddings_layer, data, embeddings_dir)
+                                           use_vm=use_vm, use_soft_pos=use_soft_pos, precision=precision).dir
+        run_generation(layer_args, data, {(use_vm, use_soft_pos): embeddings_dir}, precision,
+                       {'year': year, 'phase': phase, 'language': language, 'dirname': dirname},
+                       batch_size, n_workers, n_threads, content_store_path)
         return
 
     print(f"\nGenerating all embeddings for year {year}")
@@ -117,23 +497,33 @@ def main():
     for language in ['English', 'Dutch', 'French', 'Spanish']:
         for phase in ['Train', 'Test']:
             data = get_data(year, phase, language, dirname)
-            embeddings_layer = EmbeddingsLayer(hops=None, ontology=ontology, device=device)
-            embeddings_dir = EmbeddingsDataset(year=year, device=device, phase=phase, language=language, ont_hops=None, empty_ok=True).dir
-            generate_embeddings(embeddings_layer, data, embeddings_dir)
+            layer_args = dict(hops=None, ontology=ontology, device=device, attention_backend=attention_backend,
+                              tokenization_cache=tokenization_cache, model_name=model_name)
+            embeddings_dir = EmbeddingsDataset(year=year, device=device, phase=phase, language=language, ont_hops=None, empty_ok=True,
+                                               precision=precision).dir
+            run_generation(layer_args, data, {(True, True): embeddings_dir}, precision,
+                           {'year': year, 'phase': phase, 'language': language, 'dirname': dirname},
+                           batch_size, n_workers, n_threads, content_store_path)
 
 
-            if phase == 'Train' or 'Trial':
+            if phase != 'Test':
                 continue
 
             print("inject knowledge for test datasets")
             for ont_hops in range(3):
-                for use_vm in [True, False]:
-                    for use_soft_pos in [True, False]:
-                        embeddings_layer = EmbeddingsLayer(hops=ont_hops, ontology=ontology, use_vm=use_vm,
-                                                           use_soft_pos=use_soft_pos, device=device)
-                        embeddings_dir = EmbeddingsDataset(year=year, device=device, phase=phase, ont_hops=ont_hops,
-                                                           empty_ok=True, use_vm=use_vm, use_soft_pos=use_soft_pos).dir
-                        generate_embeddings(embeddings_layer, data, embeddings_dir)
+                layer_args = dict(hops=ont_hops, ontology=ontology, device=device,
+                                  attention_backend=attention_backend, tokenization_cache=tokenization_cache,
+                                  model_name=model_name, max_knowledge_tokens=max_knowledge_tokens,
+                                  max_target_knowledge_tokens=max_target_knowledge_tokens)
+                embeddings_dirs = {
+                    (use_vm, use_soft_pos): EmbeddingsDataset(year=year, device=device, phase=phase, language=language,
+                                                              ont_hops=ont_hops, empty_ok=True, use_vm=use_vm,
+                                                              use_soft_pos=use_soft_pos, precision=precision).dir
+                    for use_vm in [True, False] for use_soft_pos in [True, False]
+                }
+                run_generation(layer_args, data, embeddings_dirs, precision,
+                               {'year': year, 'phase': phase, 'language': language, 'dirname': dirname},
+                               batch_size, n_workers, n_threads, content_store_path)
 
 
 if __name__ == "__main__":
@@ -11,13 +11,15 @@ from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 
 from model import LCRRotHopPlusPlus
-from utils import EmbeddingsDataset, train_validation_split
+from utils import EmbeddingsDataset, EmbeddingsCache, DEFAULT_CACHE_BYTES, train_validation_split, collate_padded, \
+    LengthBucketBatchSampler
 
 
 class HyperOptManager:
     """A class that performs hyperparameter optimization and stores the best states as checkpoints."""
 
-    def __init__(self, year: int, phase: str, language: str, val_ont_hops: Optional[int]):
+    def __init__(self, year: int, phase: str, language: str, val_ont_hops: Optional[int],
+                 cache_bytes: Optional[int] = DEFAULT_CACHE_BYTES):
         self.year = year
         self.phase = phase
         self.language = language
@@ -29,6 +31,8 @@ class HyperOptManager:
         self.best_hyperparams = None
         self.best_state_dict = None
         self.trials = Trials()
+        # the embeddings are shared by all trials
+        self.cache = EmbeddingsCache(max_bytes=cache_bytes)
 
         print(torch.cuda.is_available())
         self.device = torch.device('cuda')
@@ -75,7 +79,8 @@ class HyperOptManager:
         print(f"\n\nEval {self.eval_num} with hyperparams {hyperparams}")
 
         # create training and validation DataLoader
-        train_dataset = EmbeddingsDataset(year=self.year, phase=self.phase, language=self.language, device=self.device)
+        train_dataset = EmbeddingsDataset(year=self.year, phase=self.phase, language=self.language, device=self.device,
+                                          cache=self.cache)
         print(f"Using {train_dataset} with {len(train_dataset)} obs for training")
         train_idx, validation_idx = train_validation_split(train_dataset)
 
@@ -84,14 +89,17 @@ class HyperOptManager:
         validation_subset: Subset
         if self.val_ont_hops is not None:
             train_val_dataset = EmbeddingsDataset(year=self.year, phase=self.phase, language=self.language, device=self.device,
-                                                  ont_hops=self.val_ont_hops)
+                                                  ont_hops=self.val_ont_hops, cache=self.cache)
             validation_subset = Subset(train_val_dataset, validation_idx)
             print(f"Using {train_val_dataset} with {len(validation_subset)} obs for validation")
         else:
             validation_subset = Subset(train_dataset, validation_idx)
             print(f"Using {train_dataset} with {len(validation_subset)} obs for validation")
-        training_loader = DataLoader(training_subset, batch_size=32, collate_fn=lambda batch: batch)
-        validation_loader = DataLoader(validation_subset, collate_fn=lambda batch: batch)
+        training_loader = DataLoader(training_subset, collate_fn=collate_padded,
+                                     batch_sampler=LengthBucketBatchSampler(training_subset, batch_size=32))
+        validation_loader = DataLoader(validation_subset, collate_fn=collate_padded,
+                                       batch_sampler=LengthBucketBatchSampler(validation_subset, batch_size=32,
+                                                                              shuffle=False))
 
         # Train model
         model = LCRRotHopPlusPlus(hops=lcr_hops, dropout_prob=dropout_rate).to(self.device)
@@ -111,19 +119,17 @@ class HyperOptManager:
             train_steps = 0
             train_n = 0
 
-            for i, batch in enumerate(epoch_progress):
+            for i, (batch_inputs, batch_labels) in enumerate(epoch_progress):
                 torch.set_default_device(self.device)
 
-                batch_outputs = torch.stack(
-                    [model(left, target, right, hops) for (left, target, right), _, hops in batch], dim=0)
-                batch_labels = torch.tensor([label.item() for _, label, _ in batch])
+                batch_outputs = model.forward_batch(*batch_inputs)
 
                 loss: torch.Tensor = criterion(batch_outputs, batch_labels)
                 # print(batch_labels)
                 train_loss += loss.item()
                 train_steps += 1
                 train_n_correct += (batch_outputs.argmax(1) == batch_labels).type(torch.int).sum().item()
-                train_n += len(batch)
+                train_n += len(batch_labels)
 
                 epoch_progress.set_description(
                     f"Train Loss: {train_loss / train_steps:.3f}, Train Acc.: {train_n_correct / train_n:.3f}")
@@ -135,26 +141,24 @@ class HyperOptManager:
                 torch.set_default_device('cuda')
 
             # Validation loss
-            epoch_progress = tqdm(validation_loader, unit='obs', leave=False)
+            epoch_progress = tqdm(validation_loader, unit='batch', leave=False)
             model.eval()
 
             val_loss = 0.0
             val_steps = 0
             val_n = 0
             val_n_correct = 0
-            for i, data in enumerate(epoch_progress):
+            for i, (batch_inputs, batch_labels) in enumerate(epoch_progress):
                 torch.set_default_device(self.device)
 
                 with torch.no_grad():
-                    (left, target, right), label, hops = data[0]
+                    batch_outputs: torch.Tensor = model.forward_batch(*batch_inputs)
+                    val_n_correct += (batch_outputs.argmax(1) == batch_labels).type(torch.int).sum().item()
+                    val_n += len(batch_labels)
 
-                    output: torch.Tensor = model(left, target, right, hops)
-                    val_n_correct += (output.argmax(0) == label).type(torch.int).item()
-                    val_n += 1
-
-                    loss = criterion(output, label)
-                    val_loss += loss.item()
-                    val_steps += 1
+                    loss = criterion(batch_outputs, batch_labels)
+                    val_loss += loss.item() * len(batch_labels)
+                    val_steps += len(batch_labels)
 
                     epoch_progress.set_description(
                         f"Test Loss: {val_loss / val_steps:.3f}, Test Acc.: {val_n_correct / val_n:.3f}")
@@ -171,6 +175,7 @@ class HyperOptManager:
         # we want to maximize accuracy, which is equivalent to minimizing -accuracy
         objective_loss = -best_accuracy
         self.check_best_loss(objective_loss, hyperparams, best_state_dict)
+        print(f"Using {self.cache}")
         print("current best: ")
         print(self.best_hyperparams)
         return {
@@ -208,13 +213,16 @@ def main():
     parser.add_argument("--phase", default="Train", type=str, help="phase of the data")
     parser.add_argument("--val-ont-hops", default=None, type=int, required=False,
                         help="The number of hops to use in the validation phase")
+    parser.add_argument("--cache-mb", default=2048, type=int,
+                        help="The maximum size in MiB of the embeddings that are kept in memory")
     args = parser.parse_args()
     val_ont_hops: Optional[int] = args.val_ont_hops
     year: int = args.year
     language: str = args.language
     phase: str = args.phase
 
-    opt = HyperOptManager(year=year, phase=phase, language=language, val_ont_hops=val_ont_hops)
+    opt = HyperOptManager(year=year, phase=phase, language=language, val_ont_hops=val_ont_hops,
+                          cache_bytes=args.cache_mb * 1024 ** 2)
     opt.run()
 
 
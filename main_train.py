@@ -8,7 +8,7 @@ from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
 
 from model import LCRRotHopPlusPlus
-from utils import EmbeddingsDataset, train_validation_split
+from utils import EmbeddingsDataset, EmbeddingsCache, train_validation_split, collate_padded, LengthBucketBatchSampler
 
 
 def stringify_float(value: float):
@@ -27,6 +27,8 @@ def main():
                         help="The number of hops in the ontology to use")
     parser.add_argument("--val-ont-hops", default=None, type=int, required=False,
                         help="The number of hops to use in the validation phase, this option overrides the --ont-hops option.")
+    parser.add_argument("--cache-mb", default=2048, type=int,
+                        help="The maximum size in MiB of the embeddings that are kept in memory")
     args = parser.parse_args()
 
     year: int = args.year
@@ -36,6 +38,7 @@ def main():
     lcr_hops: int = args.hops
     ont_hops: Optional[int] = args.ont_hops
     val_ont_hops: Optional[int] = args.val_ont_hops
+    cache = EmbeddingsCache(max_bytes=args.cache_mb * 1024 ** 2)
     dropout_rate = 0.7000000000000001
 
     # learning_rate, dropout_rate, momentum, weight_decay, lcr_hops = hyperparams
@@ -75,22 +78,26 @@ def main():
     device = torch.device('cuda')
 
     # create training anf validation DataLoader
-    train_dataset = EmbeddingsDataset(year=year, device=device, phase=phase, language=language, ont_hops=ont_hops)
+    train_dataset = EmbeddingsDataset(year=year, device=device, phase=phase, language=language, ont_hops=ont_hops,
+                                      cache=cache)
     print(f"Using {train_dataset} with {len(train_dataset)} obs for training")
     train_idx, validation_idx = train_validation_split(train_dataset)
 
     training_subset = Subset(train_dataset, train_idx)
 
     if val_ont_hops is not None:
-        train_val_dataset = EmbeddingsDataset(year=year, device=device, phase=phase, ont_hops=val_ont_hops)
+        train_val_dataset = EmbeddingsDataset(year=year, device=device, phase=phase, ont_hops=val_ont_hops, cache=cache)
         validation_subset = Subset(train_val_dataset, validation_idx)
         print(f"Using {train_val_dataset} with {len(validation_subset)} obs for validation")
     else:
         validation_subset = Subset(train_dataset, validation_idx)
         print(f"Using {train_dataset} with {len(validation_subset)} obs for validation")
 
-    training_loader = DataLoader(training_subset, batch_size=batch_size, collate_fn=lambda batch: batch)
-    validation_loader = DataLoader(validation_subset, collate_fn=lambda batch: batch)
+    training_loader = DataLoader(training_subset, collate_fn=collate_padded,
+                                 batch_sampler=LengthBucketBatchSampler(training_subset, batch_size=batch_size))
+    validation_loader = DataLoader(validation_subset, collate_fn=collate_padded,
+                                   batch_sampler=LengthBucketBatchSampler(validation_subset, batch_size=batch_size,
+                                                                          shuffle=False))
 
     # Train model
     model = LCRRotHopPlusPlus(hops=lcr_hops, dropout_prob=dropout_rate).to(device)
@@ -111,19 +118,17 @@ def main():
             train_steps = 0
             train_n = 0
 
-            for i, batch in enumerate(epoch_progress):
+            for i, (batch_inputs, batch_labels) in enumerate(epoch_progress):
                 torch.set_default_device(device)
 
-                batch_outputs = torch.stack(
-                    [model(left, target, right, hops) for (left, target, right), _, hops in batch], dim=0)
-                batch_labels = torch.tensor([label.item() for _, label, _ in batch])
+                batch_outputs = model.forward_batch(*batch_inputs)
 
                 loss: torch.Tensor = criterion(batch_outputs, batch_labels)
 
                 train_loss += loss.item()
                 train_steps += 1
                 train_n_correct += (batch_outputs.argmax(1) == batch_labels).type(torch.int).sum().item()
-                train_n += len(batch)
+                train_n += len(batch_labels)
 
                 epoch_progress.set_description(
                     f"Train Loss: {train_loss / train_steps:.3f}, Train Acc.: {train_n_correct / train_n:.3f}")
@@ -135,26 +140,24 @@ def main():
                 torch.set_default_device('cuda')
 
             # Validation loss
-            epoch_progress = tqdm(validation_loader, unit='obs', leave=False)
+            epoch_progress = tqdm(validation_loader, unit='batch', leave=False)
             model.eval()
 
             val_loss = 0.0
             val_steps = 0
             val_n = 0
             val_n_correct = 0
-            for i, data in enumerate(epoch_progress):
+            for i, (batch_inputs, batch_labels) in enumerate(epoch_progress):
                 torch.set_default_device(device)
 
                 with torch.no_grad():
-                    (left, target, right), label, hops = data[0]
+                    batch_outputs: torch.Tensor = model.forward_batch(*batch_inputs)
+                    val_n_correct += (batch_outputs.argmax(1) == batch_labels).type(torch.int).sum().item()
+                    val_n += len(batch_labels)
 
-                    output: torch.Tensor = model(left, target, right, hops)
-                    val_n_correct += (output.argmax(0) == label).type(torch.int).item()
-                    val_n += 1
-
-                    loss = criterion(output, label)
-                    val_loss += loss.item()
-                    val_steps += 1
+                    loss = criterion(batch_outputs, batch_labels)
+                    val_loss += loss.item() * len(batch_labels)
+                    val_steps += len(batch_labels)
 
                     epoch_progress.set_description(
                         f"Test Loss: {val_loss / val_steps:.3f}, Test Acc.: {val_n_correct / val_n:.3f}")
@@ -170,6 +173,8 @@ def main():
     except KeyboardInterrupt:
         print("Interrupted training procedure, saving best model...")
 
+    print(f"Used {cache}")
+
     if best_state_dict is not None:
         models_dir = os.path.join("data", "models")
         os.makedirs(models_dir, exist_ok=True)
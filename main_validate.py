@@ -7,11 +7,12 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 
 from model import LCRRotHopPlusPlus
-from utils import EmbeddingsDataset, CSVWriter
+from utils import EmbeddingsDataset, CSVWriter, collate_padded, LengthBucketBatchSampler, convert_store_precision
 
 
-def validate_model(model: LCRRotHopPlusPlus, dataset: EmbeddingsDataset, name='LCR-Rot-hop++'):
-    test_loader = DataLoader(dataset, collate_fn=lambda batch: batch)
+def validate_model(model: LCRRotHopPlusPlus, dataset: EmbeddingsDataset, name='LCR-Rot-hop++', batch_size=32):
+    test_loader = DataLoader(dataset, collate_fn=collate_padded,
+                             batch_sampler=LengthBucketBatchSampler(dataset, batch_size=batch_size, shuffle=False))
 
     print(f"Validating model using embeddings from {dataset}")
 
@@ -22,30 +23,30 @@ def validate_model(model: LCRRotHopPlusPlus, dataset: EmbeddingsDataset, name='L
     n_predicted = [0 for _ in range(n_classes)]
     brier_score = 0
 
-    for i, data in enumerate(tqdm(test_loader, unit='obs')):
+    for i, (inputs, labels) in enumerate(tqdm(test_loader, unit='batch')):
         torch.set_default_device(dataset.device)
 
         with torch.no_grad():
-            (left, target, right), label, hops = data[0]
+            outputs: torch.Tensor = model.forward_batch(*inputs)
+            preds = outputs.argmax(1)
 
-            output: torch.Tensor = model(left, target, right, hops)
-            pred = output.argmax(0)
-            is_correct: bool = (pred == label).item()
+            for output, pred, label in zip(outputs, preds, labels):
+                is_correct: bool = (pred == label).item()
 
-            n_label[label.item()] += 1
-            n_predicted[pred.item()] += 1
+                n_label[label.item()] += 1
+                n_predicted[pred.item()] += 1
 
-            if is_correct:
-                n_correct[label.item()] += 1
+                if is_correct:
+                    n_correct[label.item()] += 1
 
-            for j in range(n_classes):
-                if (j == label).item():
-                    brier_check = 1
-                else:
-                    brier_check = 0
+                for j in range(n_classes):
+                    if (j == label).item():
+                        brier_check = 1
+                    else:
+                        brier_check = 0
 
-                p: float = output[j].item()
-                brier_score += (p - brier_check) ** 2
+                    p: float = output[j].item()
+                    brier_score += (p - brier_check) ** 2
 
         torch.set_default_device('cuda')
 
@@ -69,6 +70,34 @@ def validate_model(model: LCRRotHopPlusPlus, dataset: EmbeddingsDataset, name='L
     return perf_measures
 
 
+def validate_precision(model: LCRRotHopPlusPlus, dataset: EmbeddingsDataset, reduced_dataset: EmbeddingsDataset,
+                       precision: str):
+    """Validate a model using float32 embeddings and embeddings with a reduced precision, and report the difference in
+    performance. The reduced embeddings are created from the float32 embeddings if they do not exist yet."""
+    if reduced_dataset.store is None:
+        if dataset.store is None:
+            raise ValueError(f"Please convert {dataset.dir} using main_embed.py --convert first")
+
+        print(f"Creating {precision} embeddings at {reduced_dataset.dir}")
+        convert_store_precision(dataset.dir, reduced_dataset.dir, precision)
+        reduced_dataset = EmbeddingsDataset(year=dataset.year, device=dataset.device, phase=dataset.phase,
+                                            language=dataset.language, ont_hops=dataset.ont_hops,
+                                            use_vm=dataset.use_vm, use_soft_pos=dataset.use_soft_pos,
+                                            precision=precision)
+
+    result = validate_model(model, dataset, 'LCR-Rot-hop++ (float32)')
+    reduced_result = validate_model(model, reduced_dataset, f'LCR-Rot-hop++ ({precision})')
+
+    n = len(dataset)
+    delta = {
+        'Correct': reduced_result['Correct'] - result['Correct'],
+        'Accuracy': f"{(reduced_result['Correct'] - result['Correct']) / n * 100:+.2f}%",
+        'Brier score': reduced_result['Brier score'] - result['Brier score'],
+    }
+
+    return result, reduced_result, delta
+
+
 def main():
     # parse CLI args
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -86,6 +115,9 @@ def main():
                         help="Whether to use soft positions")
     parser.add_argument("--ablation", default=False, type=bool, action=argparse.BooleanOptionalAction,
                         help="Run an ablation experiment, this requires all embeddings to exist for a given year.")
+    parser.add_argument("--compare-precision", default=None, choices=['float16', 'int8'], required=False,
+                        help="Report the difference in performance between float32 embeddings and embeddings with the "
+                             "given precision")
 
     #parser.add_argument("--model", type=str)
 
@@ -106,6 +138,7 @@ def main():
     use_vm: bool = args.vm
     use_soft_pos: bool = args.sp
     run_ablation: bool = args.ablation
+    compare_precision: Optional[str] = args.compare_precision
 
     device = torch.device('cuda' if torch.cuda.is_available() else
                           'mps' if torch.backends.mps.is_available() else 'cpu')
@@ -125,6 +158,20 @@ def main():
     if not run_ablation:
         dataset = EmbeddingsDataset(year=year, device=device, phase=phase, language=language, ont_hops=ont_hops, use_vm=use_vm,
                                     use_soft_pos=use_soft_pos)
+
+        if compare_precision is not None:
+            reduced_dataset = EmbeddingsDataset(year=year, device=device, phase=phase, language=language,
+                                                ont_hops=ont_hops, use_vm=use_vm, use_soft_pos=use_soft_pos,
+                                                precision=compare_precision, empty_ok=True)
+            results = validate_precision(model, dataset, reduced_dataset, compare_precision)
+
+            for title, result in zip(["float32", compare_precision, "Difference"], results):
+                print(f"\nResults {title}:")
+                for k, v in result.items():
+                    print(f"  {k}: {v}")
+
+            return
+
         result = validate_model(model, dataset)
 
         print("\nResults:")
@@ -1,2 +1,4 @@
 from .embeddings_layer import EmbeddingsLayer
 from .lcr_rot_hop_plus_plus import LCRRotHopPlusPlus
+from .ontology import OntologyIndex
+from .tokenization import TokenizationCache, TokenizedSentence
@@ -1 +1,2 @@
 from .bert_encoder import BertEncoder, BertEncoderArgs
+from .multi_headed_attn import ATTENTION_BACKENDS
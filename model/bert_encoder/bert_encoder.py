@@ -14,6 +14,11 @@ class BertEncoderArgs:
         self.heads_num = param.get("heads_num", 12)
         self.layers_num = param.get("layers_num", 12)
         self.dropout = param.get("dropout", 0.1)
+        self.attention_backend = param.get("attention_backend", "manual")
+        # the hidden states of these layers are averaged to obtain the output
+        self.pooling_layers = param.get("pooling_layers", [8, 9, 10, 11])
+        # the number of digits the output is rounded to, None disables rounding
+        self.round_digits = param.get("round_digits", 8)
 
 
 class BertEncoder(nn.Module):
@@ -24,6 +29,12 @@ class BertEncoder(nn.Module):
     def __init__(self, model, args=BertEncoderArgs()):
         super(BertEncoder, self).__init__()
         self.layers_num = args.layers_num
+        self.pooling_layers = set(args.pooling_layers)
+        self.round_digits = args.round_digits
+
+        if len(self.pooling_layers) == 0 or not all(0 <= i < self.layers_num for i in self.pooling_layers):
+            raise ValueError(f"Invalid pooling layers {args.pooling_layers} for {self.layers_num} layers")
+
         self.transformer = nn.ModuleList([
             TransformerLayer(args, model.base_model.encoder.layer._modules.get(key)) for key in
             model.base_model.encoder.layer._modules
@@ -33,20 +44,22 @@ class BertEncoder(nn.Module):
         """
         Args:
             emb: [batch_size x seq_length x emb_size]
-            vm: [seq_length x seq_length]
+            vm: [seq_length x seq_length] or [batch_size x 1 x seq_length x seq_length] attention mask, see
+                MultiHeadedAttention
         Returns:
             hidden: [batch_size x seq_length x hidden_size]
         """
 
-        # Generate mask according to segment indicators.
-        # mask: [batch_size x 1 x seq_length x seq_length]
-        hidden_layers = []
+        # only the sum of the pooled layers is kept, the layers after the last pooled layer are skipped
+        pooled: torch.Tensor | None = None
         hidden = emb
-        for i in range(self.layers_num):
+        for i in range(max(self.pooling_layers) + 1):
             hidden = self.transformer[i](hidden, vm)
-            hidden_layers.append(hidden)
 
-        hidden = (hidden_layers[11] + hidden_layers[10] + hidden_layers[9] + hidden_layers[8]) / 4
-        n_digits = 8
-        hidden = torch.round(hidden * 10 ** n_digits) / (10 ** n_digits)
+            if i in self.pooling_layers:
+                pooled = hidden if pooled is None else pooled + hidden
+
+        hidden = pooled / len(self.pooling_layers)
+        if self.round_digits is not None:
+            hidden = torch.round(hidden * 10 ** self.round_digits) / (10 ** self.round_digits)
         return hidden
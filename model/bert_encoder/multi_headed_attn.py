@@ -4,8 +4,11 @@ from typing import Optional
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from transformers import BertLayer
 
+ATTENTION_BACKENDS = ['manual', 'sdpa']
+
 
 class MultiHeadedAttention(nn.Module):
     """
@@ -13,8 +16,17 @@ class MultiHeadedAttention(nn.Module):
     self-attention refers to https://arxiv.org/pdf/1706.03762.pdf
     """
 
-    def __init__(self, hidden_size, heads_num, dropout, layer: BertLayer):
+    def __init__(self, hidden_size, heads_num, dropout, layer: BertLayer, backend='manual'):
+        """
+        Args:
+            backend: 'manual' computes the attention probabilities explicitly, 'sdpa' uses the fused
+                     torch.nn.functional.scaled_dot_product_attention kernels
+        """
         super(MultiHeadedAttention, self).__init__()
+        if backend not in ATTENTION_BACKENDS:
+            raise ValueError(f"Unknown attention backend \"{backend}\", expected one of {', '.join(ATTENTION_BACKENDS)}")
+
+        self.backend = backend
         self.hidden_size = hidden_size
         self.heads_num = heads_num
         self.per_head_size = hidden_size // heads_num
@@ -32,7 +44,8 @@ class MultiHeadedAttention(nn.Module):
             key: [batch_size x seq_length x hidden_size]
             value: [batch_size x seq_length x hidden_size]
             query: [batch_size x seq_length x hidden_size]
-            vm: [batch_size x 1 x seq_length x seq_length]
+            vm: [batch_size x 1 x seq_length x seq_length] or [seq_length x seq_length] boolean mask that is True for
+                the positions that can be attended to, or an additive mask, None if all positions can be attended to
         Returns:
             output: [batch_size x seq_length x hidden_size]
         """
@@ -58,13 +71,19 @@ class MultiHeadedAttention(nn.Module):
                              for l, x in zip(self.linear_layers, (query, key, value))
                              ]
 
+        if self.backend == 'sdpa':
+            output = unshape(F.scaled_dot_product_attention(query, key, value, attn_mask=vm))
+            return self.final_linear(output)
+
         scores = torch.matmul(query, key.transpose(-2, -1))
         scores = scores / math.sqrt(float(per_head_size))
 
-        if vm is not None:
+        if vm is not None and vm.dtype == torch.bool:
+            scores = scores.masked_fill(~vm, -torch.inf)
+        elif vm is not None:
             scores = scores + vm
 
-        probs = nn.Softmax(dim=-1)(scores)
+        probs = torch.softmax(scores, dim=-1)
         output = unshape(torch.matmul(probs.float(), value.float()))
         output = self.final_linear(output)
 
@@ -20,7 +20,7 @@ class TransformerLayer(nn.Module):
 
         # Multi-headed self-attention.
         self.self_attn = MultiHeadedAttention(
-            args.hidden_size, args.heads_num, args.dropout, layer
+            args.hidden_size, args.heads_num, args.dropout, layer, args.attention_backend
         )
 
         self.layer_norm_1 = LayerNorm(args.hidden_size, layer.attention.output.LayerNorm)
@@ -35,7 +35,8 @@ class TransformerLayer(nn.Module):
         """
         Args:
             hidden: [batch_size x seq_length x emb_size]
-            vm: [seq_length x seq_length]
+            vm: [seq_length x seq_length] or [batch_size x 1 x seq_length x seq_length] attention mask, see
+                MultiHeadedAttention
         Returns:
             output: [batch_size x seq_length x hidden_size]
         """
@@ -1,75 +1,395 @@
+import json
+from dataclasses import dataclass
 from typing import Optional
 
 import torch
 from rdflib import Graph
-from transformers import BertTokenizer, BertModel
+from transformers import BertTokenizerFast, BertModel
 
-from .bert_encoder import BertEncoder
-from .sentence_tree import SentenceTree
+from .bert_encoder import BertEncoder, BertEncoderArgs
+from .ontology import OntologyIndex
+from .sentence_tree import FlatSentenceTree, KnowledgeCache
+from .tokenization import TokenizationCache, TokenizedSentence
 
-tokenizer: BertTokenizer = BertTokenizer.from_pretrained('bert-base-multilingual-cased')
-model: BertModel = BertModel.from_pretrained("bert-base-multilingual-cased")
-# print empty line after bert-base-uncased warnings
-print()
+DEFAULT_MODEL_NAME = 'bert-base-multilingual-cased'
+
+_pretrained: dict[str, tuple[BertTokenizerFast, BertModel]] = {}
+
+
+def load_pretrained(model_name: str) -> tuple[BertTokenizerFast, BertModel]:
+    """Load the tokenizer and model with the given name, the model is only loaded the first time it is requested."""
+    if model_name not in _pretrained:
+        tokenizer = BertTokenizerFast.from_pretrained(model_name)
+        model = BertModel.from_pretrained(model_name)
+        # print empty line after the warnings of transformers
+        print()
+        _pretrained[model_name] = (tokenizer, model)
+
+    return _pretrained[model_name]
+
+
+@dataclass
+class EncoderInput:
+    """The input of a single sequence for the BertEncoder, including the [CLS] and [SEP] tokens."""
+    input_ids: torch.Tensor
+    """[seq_length] the token ids"""
+    position_ids: Optional[torch.Tensor] = None
+    """[seq_length] optional (soft) positions, the default positions are used if this is None"""
+    vm: Optional[torch.Tensor] = None
+    """[seq_length x seq_length] optional boolean visible matrix, True for visible tokens, None if all tokens can see
+    each other"""
+    target: Optional[tuple[int, int]] = None
+    """optional start and end index of the target, long sequences are split into windows around the target"""
+
+    def __len__(self):
+        return len(self.input_ids)
+
+
+@dataclass
+class PreparedBatch:
+    """The encoder inputs of a batch of opinions, see EmbeddingsLayer.prepare_variants."""
+    inputs: list[EncoderInput]
+    outputs: list[list[tuple[int, tuple[int, int], Optional[torch.Tensor]]]]
+    """for each variant and each opinion, the index of its input, the target position and the hops"""
 
 
 class EmbeddingsLayer:
-    def __init__(self, hops: Optional[int] = None, ontology: Optional[Graph] = None, use_vm=True, use_soft_pos=True,
-                 device=torch.device('cpu')):
+    def __init__(self, hops: Optional[int] = None, ontology: Optional[Graph | OntologyIndex] = None, use_vm=True,
+                 use_soft_pos=True, device=torch.device('cpu'), attention_backend='manual',
+                 pooling_layers=(8, 9, 10, 11), round_digits: Optional[int] = 8,
+                 max_knowledge_tokens: Optional[int] = None, max_target_knowledge_tokens: Optional[int] = None,
+                 max_length: Optional[int] = 512, window_size: Optional[int] = None,
+                 window_stride: Optional[int] = None, tokenization_cache: Optional[TokenizationCache] = None,
+                 model_name=DEFAULT_MODEL_NAME):
+        """
+        :param attention_backend: the implementation of the self-attention in the encoder, see ATTENTION_BACKENDS
+        :param pooling_layers: the (zero-based) encoder layers that are averaged to obtain the embeddings
+        :param round_digits: the number of digits the embeddings are rounded to, None disables rounding
+        :param max_knowledge_tokens: the maximum number of inserted tokens per sentence, None for no limit
+        :param max_target_knowledge_tokens: the maximum number of inserted tokens per target word, None for no limit
+        :param max_length: knowledge is only inserted up to this sequence length
+        :param window_size: longer sequences are encoded in overlapping windows of this size, defaults to the maximum
+                            number of positions of the model
+        :param window_stride: the distance between the starts of consecutive windows, defaults to half of the window
+                              size
+        :param tokenization_cache: the cache of the tokenized sentences, use a persisted cache to skip the tokenization
+                                   when embeddings are generated again
+        :param model_name: the name of the pretrained BERT model, it is loaded when the first EmbeddingsLayer is
+                           created
+        """
         super().__init__()
 
         self.ont_hops = hops
-        self.ontology = ontology
+        # all lookups use an in-memory index of the ontology, which is built once
+        self.ontology: Optional[OntologyIndex] = OntologyIndex.from_graph(ontology) if isinstance(ontology, Graph) \
+            else ontology
         self.use_vm = use_vm
         self.use_soft_pos = use_soft_pos
+        self.max_knowledge_tokens = max_knowledge_tokens
+        self.max_target_knowledge_tokens = max_target_knowledge_tokens
+        self.max_length = max_length
+        self.knowledge_stats = {
+            'sentences': 0,
+            'pruned_sentences': 0,
+            'inserted_tokens': 0,
+            'pruned_tokens': 0,
+            'pruned_nodes': 0,
+        }
+        """the number of inserted and pruned knowledge tokens over all calls of forward_batch"""
 
         self.device = device
-        self.tokenizer: BertTokenizer = tokenizer
+        self.model_name = model_name
+        self.attention_backend = attention_backend
+        self.pooling_layers = list(pooling_layers)
+        self.round_digits = round_digits
+        tokenizer, model = load_pretrained(model_name)
+        self.tokenizer: BertTokenizerFast = tokenizer
+        self.tokenization_cache = tokenization_cache if tokenization_cache is not None else TokenizationCache()
+        # the knowledge below a concept is expanded once and shared by all sentences
+        self.knowledge_cache: Optional[KnowledgeCache] = KnowledgeCache(self.ontology, self.tokenizer) \
+            if self.ontology is not None else None
         self.model: BertModel = model.to(device)
         self.model.eval()
-        self.encoder = BertEncoder(self.model)
+
+        # the encoder reuses the layers of the model, so it takes its dimensions from the model
+        config = self.model.config
+        if getattr(getattr(self.model.base_model, 'encoder', None), 'layer', None) is None or \
+                config.hidden_size % config.num_attention_heads != 0:
+            raise ValueError(f"The model {model_name} is not supported, expected a BERT model")
+        self.encoder = BertEncoder(self.model, BertEncoderArgs({
+            'emb_size': config.hidden_size,
+            'hidden_size': config.hidden_size,
+            'heads_num': config.num_attention_heads,
+            'layers_num': config.num_hidden_layers,
+            'feedforward_size': config.intermediate_size,
+            'attention_backend': attention_backend,
+            'pooling_layers': list(pooling_layers),
+            'round_digits': round_digits,
+        }))
+
+        self.window_size: int = window_size if window_size is not None else \
+            self.model.config.max_position_embeddings
+        self.window_stride: int = window_stride if window_stride is not None else max(self.window_size // 2, 1)
+        if not 0 < self.window_stride <= self.window_size:
+            raise ValueError(f"The window stride should be between 1 and the window size {self.window_size}, "
+                             f"got {self.window_stride}")
+
+    @property
+    def encoder_id(self) -> str:
+        """Identifies the model, the ontology and the settings that determine the embeddings, apart from the hops,
+        visible matrix and soft positions."""
+        return json.dumps({
+            'model_name': self.model_name,
+            'ontology': self.ontology.source_hash if self.injects_knowledge() else None,
+            'attention_backend': self.attention_backend,
+            'pooling_layers': self.pooling_layers,
+            'round_digits': self.round_digits,
+            'max_knowledge_tokens': self.max_knowledge_tokens,
+            'max_target_knowledge_tokens': self.max_target_knowledge_tokens,
+            'max_length': self.max_length,
+            'window_size': self.window_size,
+            'window_stride': self.window_stride,
+        }, sort_keys=True)
+
+    def injects_knowledge(self):
+        """Returns True if knowledge from the ontology is inserted into the sentences."""
+        return self.ont_hops is not None and self.ont_hops >= 0 and self.ontology is not None
 
     def forward(self, sentence: str, target_start: int, target_end: int) -> tuple[
         torch.Tensor, tuple[int, int], Optional[torch.Tensor]
     ]:
-        sentence = f"[CLS] {sentence} [SEP]"
-        target_start += 6
-        target_end += 6
+        return self.forward_batch([(sentence, target_start, target_end)])[0]
+
+    def forward_sentence(self, sentence: str, targets: list[tuple[int, int]]) -> list[tuple[
+        torch.Tensor, tuple[int, int], Optional[torch.Tensor]
+    ]]:
+        """Generate the embeddings for multiple targets in the same sentence. Without knowledge injection, the token
+        sequence does not depend on the target, so the sentence is encoded only once and the result is shared by all
+        targets.
+
+        :param sentence: the sentence
+        :param targets: the start and end character index of each target
+        :return: the result of forward for each target
+        """
+        return self.forward_batch([(sentence, target_start, target_end) for target_start, target_end in targets])
+
+    def forward_batch(self, items: list[tuple[str, int, int]]) -> list[tuple[
+        torch.Tensor, tuple[int, int], Optional[torch.Tensor]
+    ]]:
+        """Generate the embeddings for multiple opinions using a single call to the encoder. The sequences are padded
+        and every sequence gets its own attention mask, which combines the padding with its visible matrix. Without
+        knowledge injection, every distinct sentence is encoded only once.
+
+        :param items: the sentence, and the start and end character index of the target of each opinion
+        :return: the result of forward for each opinion
+        """
+        return self.forward_variants(items, [(self.use_vm, self.use_soft_pos)])[0]
+
+    def forward_variants(self, items: list[tuple[str, int, int]], variants: list[tuple[bool, bool]]) -> list[list[
+        tuple[torch.Tensor, tuple[int, int], Optional[torch.Tensor]]
+    ]]:
+        """Generate the embeddings for multiple opinions for each combination of use_vm and use_soft_pos in variants.
+        The sentence trees are built only once, and the variants that result in the same input for the encoder share
+        their output, e.g., the visible matrix has no effect if no knowledge was inserted into a sentence.
+
+        :param items: the sentence, and the start and end character index of the target of each opinion
+        :param variants: the use_vm and use_soft_pos value of each variant
+        :return: the result of forward_batch for each variant
+        """
+        return self.encode_prepared(self.prepare_variants(items, variants))
+
+    def prepare_variants(self, items: list[tuple[str, int, int]], variants: list[tuple[bool, bool]]) -> PreparedBatch:
+        """Tokenize the sentences and build the sentence trees of forward_variants, without running the encoder. The
+        result is passed to encode_prepared, which allows the preparation of the next batch to overlap with the
+        encoder."""
+        # all sentences are tokenized at once, the offsets of the tokens locate the targets
+        tokenized = self.tokenization_cache.tokenize([sentence for sentence, _, _ in items], self.tokenizer)
+
+        # without knowledge the variants do not differ
+        if not self.injects_knowledge():
+            return self.__prepare_sentences(items, tokenized, len(variants))
 
-        # insert knowledge
-        if self.ont_hops is not None and self.ont_hops >= 0 and self.ontology is not None:
-            tree = SentenceTree(sentence, target_start, target_end, self.ontology, self.tokenizer, self.device,
-                                self.ont_hops)
+        inputs: list[EncoderInput] = []
+        input_indices: dict[tuple[int, bool, bool], int] = {}
+        outputs: list[list[tuple[int, tuple[int, int], Optional[torch.Tensor]]]] = [[] for _ in variants]
+
+        for i, (sentence, target_start, target_end) in enumerate(items):
+            tree = FlatSentenceTree(sentence, target_start, target_end, self.ontology, self.tokenizer,
+                                    self.device, self.ont_hops, knowledge_cache=self.knowledge_cache,
+                                    max_knowledge_tokens=self.max_knowledge_tokens,
+                                    max_target_knowledge_tokens=self.max_target_knowledge_tokens,
+                                    max_length=self.max_length, tokenized=tokenized[sentence])
+            self.knowledge_stats['sentences'] += 1
+            self.knowledge_stats['inserted_tokens'] += tree.n_knowledge_tokens
+            if tree.n_pruned_tokens > 0:
+                self.knowledge_stats['pruned_sentences'] += 1
+                self.knowledge_stats['pruned_tokens'] += tree.n_pruned_tokens
+                self.knowledge_stats['pruned_nodes'] += tree.n_pruned_nodes
 
             # generate embeddings for the BERT model
             tree_embeddings = tree.build_embedding()
-            target_index_start = tree_embeddings.target_start - 1
-            target_index_end = tree_embeddings.target_end - 1
-
-            # generate embeddings using pre-trained BERT model
-            initial_embeddings = self.model.embeddings.forward(
-                input_ids=tree_embeddings.input_ids,
-                token_type_ids=tree_embeddings.token_type_ids,
-                position_ids=tree_embeddings.position_ids if self.use_soft_pos else None
-            )
-            embeddings: torch.Tensor = self.encoder(initial_embeddings, vm=tree_embeddings.vm if self.use_vm else None)
-            embeddings = embeddings[0][1:-1]
+            # a matrix in which all tokens are visible does not need to be applied
+            has_vm = not bool(tree_embeddings.vm.all())
+            target_pos = (tree_embeddings.target_start - 1, tree_embeddings.target_end - 1)
             hops = tree_embeddings.hops[1:-1]
 
-            return embeddings, (target_index_start, target_index_end), hops
+            for j, (use_vm, use_soft_pos) in enumerate(variants):
+                key = (i, use_vm and has_vm, use_soft_pos)
+                if key not in input_indices:
+                    input_indices[key] = len(inputs)
+                    inputs.append(EncoderInput(
+                        input_ids=tree_embeddings.input_ids[0],
+                        position_ids=tree_embeddings.position_ids[0] if use_soft_pos else None,
+                        vm=tree_embeddings.vm if use_vm and has_vm else None,
+                        target=(tree_embeddings.target_start, tree_embeddings.target_end)
+                    ))
+                outputs[j].append((input_indices[key], target_pos, hops))
+
+        return PreparedBatch(inputs, outputs)
+
+    def __prepare_sentences(self, items: list[tuple[str, int, int]], tokenized: dict[str, TokenizedSentence],
+                            n_variants: int) -> PreparedBatch:
+        """Prepare the inputs without knowledge injection, every distinct sentence is encoded only once."""
+        sentences: dict[str, int] = {}
+        inputs: list[EncoderInput] = []
+        for sentence, _, _ in items:
+            if sentence in sentences:
+                continue
+
+            sentences[sentence] = len(inputs)
+            inputs.append(EncoderInput(
+                input_ids=torch.tensor(tokenized[sentence].input_ids, device=self.device)
+            ))
+
+        outputs: list[tuple[int, tuple[int, int], Optional[torch.Tensor]]] = []
+        for sentence, target_start, target_end in items:
+            # the embeddings do not include the [CLS] token
+            target_index_start, target_index_end = tokenized[sentence].target_span(target_start, target_end)
+
+            outputs.append((sentences[sentence], (target_index_start - 1, target_index_end - 1), None))
+
+        return PreparedBatch(inputs, [outputs for _ in range(n_variants)])
+
+    def encode_prepared(self, prepared: PreparedBatch) -> list[list[
+        tuple[torch.Tensor, tuple[int, int], Optional[torch.Tensor]]
+    ]]:
+        """Run the encoder for a batch that is returned by prepare_variants.
+
+        :return: the result of forward_batch for each variant
+        """
+        embeddings = [sequence_embeddings[1:-1] for sequence_embeddings in self.encode(prepared.inputs)]
+        return [
+            [(embeddings[k], target_pos, hops) for k, target_pos, hops in outputs]
+            for outputs in prepared.outputs
+        ]
+
+    def encode(self, inputs: list[EncoderInput]) -> list[torch.Tensor]:
+        """Run the encoder once for a batch of sequences of possibly different lengths. Sequences that are longer than
+        the window size are split into overlapping windows, one of which is centred on the target, and the hidden
+        states of tokens that are in multiple windows are averaged.
+
+        :param inputs: the input of each sequence
+        :return: [seq_length x hidden_size] the hidden states of each sequence, without padding
+        """
+        window_inputs: list[EncoderInput] = []
+        windows: list[list[int]] = []
+        for item in inputs:
+            starts = self.__window_starts(item)
+            windows.append(starts)
+
+            if len(starts) == 1:
+                window_inputs.append(item)
+                continue
+
+            for start in starts:
+                end = start + self.window_size
+                position_ids = item.position_ids[start:end] if item.position_ids is not None else None
+                window_inputs.append(EncoderInput(
+                    input_ids=item.input_ids[start:end],
+                    # soft positions are shifted to start at 0, such that they are within the positions of the model
+                    position_ids=position_ids - position_ids.min() if position_ids is not None else None,
+                    vm=item.vm[start:end, start:end] if item.vm is not None else None
+                ))
+
+        window_embeddings = self.__encode_padded(window_inputs)
+        if len(window_inputs) == len(inputs):
+            return window_embeddings
+
+        results: list[torch.Tensor] = []
+        i = 0
+        for item, starts in zip(inputs, windows):
+            if len(starts) == 1:
+                results.append(window_embeddings[i])
+                i += 1
+                continue
+
+            total = torch.zeros(len(item), window_embeddings[i].size(1), device=window_embeddings[i].device)
+            counts = torch.zeros(len(item), 1, device=total.device)
+            for start in starts:
+                end = start + self.window_size
+                total[start:end] += window_embeddings[i]
+                counts[start:end] += 1
+                i += 1
+            results.append(total / counts)
+
+        return results
+
+    def __window_starts(self, item: EncoderInput) -> list[int]:
+        """Returns the start index of each window of the sequence, the windows cover the whole sequence and one window
+        is centred on the target (or starts at the beginning of the sequence without target)."""
+        length = len(item)
+        if length <= self.window_size:
+            return [0]
+
+        centre = (item.target[0] + item.target[1]) // 2 if item.target is not None else 0
+        centre_start = min(max(centre - self.window_size // 2, 0), length - self.window_size)
+
+        starts = {centre_start, 0, length - self.window_size}
+        start = centre_start - self.window_stride
+        while start > 0:
+            starts.add(start)
+            start -= self.window_stride
+        start = centre_start + self.window_stride
+        while start < length - self.window_size:
+            starts.add(start)
+            start += self.window_stride
+
+        return sorted(starts)
+
+    def __encode_padded(self, inputs: list[EncoderInput]) -> list[torch.Tensor]:
+        """Run the encoder once for a batch of sequences that fit in the model, the sequences are padded."""
+        batch_size = len(inputs)
+        lengths = [len(item) for item in inputs]
+        max_length = max(lengths)
+
+        input_ids = torch.zeros(batch_size, max_length, dtype=torch.long, device=self.device)
+        token_type_ids = torch.zeros(batch_size, max_length, dtype=torch.long, device=self.device)
+        use_position_ids = any(item.position_ids is not None for item in inputs)
+        position_ids = torch.zeros(batch_size, max_length, dtype=torch.long, device=self.device) \
+            if use_position_ids else None
 
-        # do not insert knowledge
-        left_str = self.tokenizer.tokenize(sentence[0:target_start])
-        target_str = self.tokenizer.tokenize(sentence[target_start:target_end])
-        target_index_start = len(left_str) - 1
-        target_index_end = target_index_start + len(target_str)
+        for i, item in enumerate(inputs):
+            input_ids[i, :lengths[i]] = item.input_ids
+            if position_ids is not None:
+                position_ids[i, :lengths[i]] = item.position_ids if item.position_ids is not None else \
+                    torch.arange(lengths[i], device=self.device)
 
-        tokens = self.tokenizer.tokenize(sentence)
-        ids = torch.tensor([self.tokenizer.convert_tokens_to_ids(tokens)], device=self.device)
-        token_type_ids = torch.tensor([[0] * len(tokens)], device=self.device)
+        # a single sequence does not need padding, and no mask is needed if all tokens are visible
+        mask: Optional[torch.Tensor]
+        if batch_size == 1:
+            mask = inputs[0].vm.to(self.device) if inputs[0].vm is not None else None
+        elif all(item.vm is None and length == max_length for item, length in zip(inputs, lengths)):
+            mask = None
+        else:
+            # [batch_size x 1 x max_length x max_length] boolean mask, padding can not be seen by any token
+            mask = torch.ones(batch_size, 1, max_length, max_length, dtype=torch.bool, device=self.device)
+            for i, item in enumerate(inputs):
+                mask[i, 0, :, lengths[i]:] = False
+                if item.vm is not None:
+                    mask[i, 0, :lengths[i], :lengths[i]] = item.vm
 
-        initial_embeddings = self.model.embeddings.forward(input_ids=ids, token_type_ids=token_type_ids)
-        embeddings: torch.Tensor = self.encoder(initial_embeddings)
-        embeddings = embeddings[0][1:-1]
+        initial_embeddings = self.model.embeddings.forward(input_ids=input_ids, token_type_ids=token_type_ids,
+                                                           position_ids=position_ids)
+        embeddings: torch.Tensor = self.encoder(initial_embeddings, vm=mask)
 
-        return embeddings, (target_index_start, target_index_end), None
+        return [embeddings[i, :lengths[i]] for i in range(batch_size)]
@@ -2,6 +2,24 @@ from typing import Optional
 
 import torch
 from torch import nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+
+
+def masked_softmax(scores: torch.Tensor, mask: torch.Tensor, dim: int):
+    """Softmax that ignores the positions where mask is False. Rows without any valid position result in zeros instead
+    of NaN values."""
+    scores = scores.masked_fill(~mask, -torch.inf)
+    probs = torch.softmax(scores, dim=dim)
+    return probs.masked_fill(~mask, 0.0)
+
+
+def length_mask(lengths: torch.Tensor, max_length: int):
+    """
+    :param lengths: [batch_size] the number of valid positions of each sequence
+    :param max_length: the padded length of the sequences
+    :return: [batch_size x max_length] boolean mask that is True for valid positions
+    """
+    return torch.arange(max_length, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)
 
 
 class BilinearAttention(nn.Module):
@@ -29,6 +47,24 @@ class BilinearAttention(nn.Module):
 
         return torch.einsum('ij,ik->k', att_scores, hidden_states)
 
+    def forward_batch(self, hidden_states: torch.Tensor, representation: torch.Tensor, mask: torch.Tensor):
+        """
+        :param hidden_states: [batch_size x n x input_size] padded hidden states
+        :param representation: [batch_size x input_size]
+        :param mask: [batch_size x n] boolean mask that is True for the tokens that are not padding
+        :return: [batch_size x input_size] the new representations
+        """
+        _, n_hidden_states, _ = hidden_states.size()
+
+        # [batch_size x n_hidden_states]
+        att_scores = self.tanh(self.bilinear(
+            hidden_states,
+            representation.unsqueeze(1).expand(-1, n_hidden_states, -1).contiguous()
+        )).squeeze(-1)
+        att_scores = masked_softmax(att_scores, mask, dim=1)
+
+        return torch.einsum('bi,bik->bk', att_scores, hidden_states)
+
 
 class HierarchicalAttention(nn.Module):
     def __init__(self, input_size: int):
@@ -54,6 +90,24 @@ class HierarchicalAttention(nn.Module):
 
         return representation1, representation2
 
+    def forward_batch(self, representation1: torch.Tensor, representation2: torch.Tensor):
+        """
+        :param representation1: [batch_size x input_size]
+        :param representation2: [batch_size x input_size]
+        :return: representation1, representation2: the representations scaled by their corresponding attention score
+        """
+        representations = torch.cat((
+            self.tanh(self.linear(representation1)),
+            self.tanh(self.linear(representation2))
+        ), dim=1)
+
+        # [batch_size x 2]
+        attention_scores = torch.softmax(representations, dim=1)
+        representation1 = attention_scores[:, 0:1] * representation1
+        representation2 = attention_scores[:, 1:2] * representation2
+
+        return representation1, representation2
+
 
 class LCRRotHopPlusPlus(nn.Module):
     def __init__(self, dropout_prob=0.7, output_size=3, input_size=768, hidden_size=300, hops=3,
@@ -181,3 +235,114 @@ class LCRRotHopPlusPlus(nn.Module):
             output = self.softmax(output)
 
         return output
+
+    def __hops_weights(self, hops: torch.Tensor):
+        """Convert a tensor of hops to the weights that are used to scale the embeddings."""
+        hops = hops.float()
+        return torch.where(hops < 0, torch.ones_like(hops), 1 / (self.gamma + hops))
+
+    def __run_lstm(self, lstm: nn.LSTM, inputs: torch.Tensor, lengths: torch.Tensor):
+        """Run an LSTM over a padded batch using packed sequences, the output is padded with zeros."""
+        batch_size, max_length, input_size = inputs.size()
+
+        # empty sequences are not allowed in a packed sequence, their hidden states are masked out anyway
+        if max_length == 0:
+            inputs = inputs.new_zeros(batch_size, 1, input_size)
+        packed = pack_padded_sequence(self.dropout(inputs), lengths.clamp(min=1).cpu(), batch_first=True,
+                                      enforce_sorted=False)
+        hidden_states, _ = lstm(packed)
+        hidden_states, _ = pad_packed_sequence(hidden_states, batch_first=True, total_length=max(max_length, 1))
+
+        return hidden_states[:, :max_length]
+
+    def forward_batch(self, left: torch.Tensor, target: torch.Tensor, right: torch.Tensor, left_lengths: torch.Tensor,
+                      target_lengths: torch.Tensor, right_lengths: torch.Tensor,
+                      hops: Optional[tuple[torch.Tensor, torch.Tensor, torch.Tensor]] = None):
+        """
+        Batched version of forward, which processes multiple opinions using a single call.
+
+        :param left: [batch_size x max_left x input_size] padded left-context embeddings
+        :param target: [batch_size x max_target x input_size] padded target embeddings
+        :param right: [batch_size x max_right x input_size] padded right-context embeddings
+        :param left_lengths: [batch_size] the number of tokens in each left context, this can be 0
+        :param target_lengths: [batch_size] the number of tokens in each target, this must be at least 1
+        :param right_lengths: [batch_size] the number of tokens in each right context, this can be 0
+        :param hops: optional padded hops for the left context, target and right context, see forward
+        :return: [batch_size x output_size] output probabilities for each class
+        """
+        batch_size, max_left, _ = left.size()
+        _, max_target, _ = target.size()
+        _, max_right, _ = right.size()
+
+        left_mask = length_mask(left_lengths, max_left)
+        target_mask = length_mask(target_lengths, max_target)
+        right_mask = length_mask(right_lengths, max_right)
+
+        # [batch_size x 1] indicators for the opinions that have a left or right context
+        has_left = (left_lengths > 0).unsqueeze(1)
+        has_right = (right_lengths > 0).unsqueeze(1)
+        has_both = has_left & has_right
+
+        # determine weights and scale embeddings
+        if self.gamma is not None and hops is not None:
+            hops_left, hops_target, hops_right = hops
+            left = left * self.__hops_weights(hops_left).unsqueeze(-1)
+            target = target * self.__hops_weights(hops_target).unsqueeze(-1)
+            right = right * self.__hops_weights(hops_right).unsqueeze(-1)
+
+        # calculate hidden states
+        left_hidden_states = self.__run_lstm(self.lstm_left, left, left_lengths)
+        target_hidden_states = self.__run_lstm(self.lstm_target, target, target_lengths)
+        right_hidden_states = self.__run_lstm(self.lstm_right, right, right_lengths)
+
+        # initial representations using pooling
+        representation_target_left = target_hidden_states.sum(dim=1) / target_lengths.unsqueeze(1)
+        representation_target_right = representation_target_left
+
+        representation_left = torch.zeros(batch_size, self.representation_size, device=left.device)
+        representation_right = torch.zeros(batch_size, self.representation_size, device=right.device)
+
+        # rotatory attention, opinions without a left or right context keep their previous representations
+        for i in range(self.hops):
+            # target-to-context
+            representation_left = torch.where(
+                has_left,
+                self.bilinear_left.forward_batch(left_hidden_states, representation_target_left, left_mask),
+                representation_left)
+            representation_right = torch.where(
+                has_right,
+                self.bilinear_right.forward_batch(right_hidden_states, representation_target_right, right_mask),
+                representation_right)
+
+            context_left, context_right = self.hierarchical_context.forward_batch(representation_left,
+                                                                                  representation_right)
+            representation_left = torch.where(has_both, context_left, representation_left)
+            representation_right = torch.where(has_both, context_right, representation_right)
+
+            # context-to-target
+            target_left = self.bilinear_target_left.forward_batch(target_hidden_states, representation_left,
+                                                                  target_mask)
+            target_right = self.bilinear_target_right.forward_batch(target_hidden_states, representation_right,
+                                                                    target_mask)
+            hierarchical_left, hierarchical_right = self.hierarchical_target.forward_batch(target_left, target_right)
+
+            representation_target_left = torch.where(
+                has_both, hierarchical_left, torch.where(has_left, target_left, representation_target_left))
+            representation_target_right = torch.where(
+                has_both, hierarchical_right, torch.where(has_right, target_right, representation_target_right))
+
+        # determine output probabilities
+        output = torch.concat([
+            representation_left,
+            representation_target_left,
+            representation_target_right,
+            representation_right,
+        ], dim=1)
+        output = self.dropout(output)
+        output = self.output_linear(output)
+
+        # CrossEntropyLoss requires raw logits
+        if not self.training:
+            output = torch.softmax(output, dim=1)
+
+        return output
@@ -1,24 +1,169 @@
 """Utility functions that are specific to this ontology"""
+import hashlib
+import os
+import pickle
+from collections import defaultdict
+from typing import Optional
 
-from rdflib import URIRef, Graph
+from rdflib import URIRef, Graph, Literal, RDFS
 
 NAMESPACE = "http://www.kimschouten.com/sentiment/restaurant"
+LEX = URIRef("#lex", NAMESPACE)
+SNAPSHOT_VERSION = 1
 
 
-def find_synonyms_for(resource: URIRef, ontology: Graph) -> list[str]:
-    lex = [str(item[2]) for item in ontology.triples((resource, URIRef("#lex", NAMESPACE), None))]
+class OntologyIndex:
+    """An in-memory index of the lexicalisations and the class hierarchy of an ontology, which is built once from a
+    Graph. All lookups are dictionary lookups, so this is much faster than querying the Graph for every token."""
+
+    def __init__(self, uris_by_lex: dict[str, URIRef], synonyms: dict[URIRef, list[str]],
+                 subclasses: dict[URIRef, list[URIRef]], superclasses: dict[URIRef, list[URIRef]],
+                 source_hash: Optional[str] = None):
+        """
+        :param source_hash: identifies the ontology this index was built from, defaults to a hash of the index
+        """
+        self.uris_by_lex = uris_by_lex
+        self.synonyms = synonyms
+        self.subclasses = subclasses
+        self.superclasses = superclasses
+        self.__source_hash = source_hash
+
+    @property
+    def source_hash(self) -> str:
+        """The sha256 of the ontology file this index was loaded from, or of the contents of the index if it was not
+        loaded from a file. Embeddings that are generated with the same source_hash contain the same knowledge."""
+        if self.__source_hash is None:
+            contents = pickle.dumps((
+                sorted((lex, str(uri)) for lex, uri in self.uris_by_lex.items()),
+                sorted((str(uri), synonyms) for uri, synonyms in self.synonyms.items()),
+                sorted((str(uri), [str(item) for item in items]) for uri, items in self.subclasses.items()),
+                sorted((str(uri), [str(item) for item in items]) for uri, items in self.superclasses.items()),
+            ), protocol=4)
+            self.__source_hash = hashlib.sha256(contents).hexdigest()
+        return self.__source_hash
+
+    @staticmethod
+    def from_graph(ontology: Graph) -> 'OntologyIndex':
+        uris_by_lex: dict[str, URIRef] = {}
+        synonyms: defaultdict[URIRef, list[str]] = defaultdict(list)
+        subclasses: defaultdict[URIRef, list[URIRef]] = defaultdict(list)
+        superclasses: defaultdict[URIRef, list[URIRef]] = defaultdict(list)
+
+        for subject, _, lex in ontology.triples((None, LEX, None)):
+            synonyms[subject].append(str(lex))
+            uris_by_lex.setdefault(str(lex), subject)
+
+        for subclass, _, superclass in ontology.triples((None, RDFS.subClassOf, None)):
+            if not isinstance(subclass, URIRef) or not isinstance(superclass, URIRef):
+                continue
+            subclasses[superclass].append(subclass)
+            superclasses[subclass].append(superclass)
+
+        return OntologyIndex(uris_by_lex, dict(synonyms), dict(subclasses), dict(superclasses))
+
+    @staticmethod
+    def from_owl(path: str, snapshot_path: Optional[str] = None) -> 'OntologyIndex':
+        """Load the index of the ontology at path. The index is stored in a compiled snapshot next to the ontology,
+        which is rebuilt automatically when the contents of the ontology change.
+
+        :param path: path to the ontology file
+        :param snapshot_path: path to the snapshot, defaults to path + '.index'
+        """
+        if snapshot_path is None:
+            snapshot_path = f"{path}.index"
+
+        with open(path, "rb") as f:
+            source_hash = hashlib.sha256(f.read()).hexdigest()
+
+        if os.path.isfile(snapshot_path):
+            index = OntologyIndex.load(snapshot_path, source_hash)
+            if index is not None:
+                return index
+
+        print(f"Compiling ontology {path} into {snapshot_path}")
+        graph_index = OntologyIndex.from_graph(Graph().parse(path))
+        index = OntologyIndex(graph_index.uris_by_lex, graph_index.synonyms, graph_index.subclasses,
+                              graph_index.superclasses, source_hash)
+        index.save(snapshot_path, source_hash)
+        return index
+
+    def save(self, path: str, source_hash: str):
+        """Save this index as a compiled snapshot, the source_hash identifies the ontology it was built from."""
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'source_hash': source_hash,
+            'uris_by_lex': {lex: str(uri) for lex, uri in self.uris_by_lex.items()},
+            'synonyms': {str(uri): synonyms for uri, synonyms in self.synonyms.items()},
+            'subclasses': {str(uri): [str(item) for item in items] for uri, items in self.subclasses.items()},
+            'superclasses': {str(uri): [str(item) for item in items] for uri, items in self.superclasses.items()},
+        }
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f"{path}.tmp", "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def load(path: str, source_hash: Optional[str] = None) -> Optional['OntologyIndex']:
+        """Load a compiled snapshot, returns None if the snapshot was built from a different ontology (source_hash) or
+        by an incompatible version."""
+        with open(path, "rb") as f:
+            snapshot: dict = pickle.load(f)
+
+        if snapshot.get('version') != SNAPSHOT_VERSION or (
+                source_hash is not None and snapshot.get('source_hash') != source_hash):
+            return None
+
+        uris: dict[str, URIRef] = {}
+
+        def to_uri(value: str):
+            # share URIRef instances between the maps
+            if value not in uris:
+                uris[value] = URIRef(value)
+            return uris[value]
+
+        return OntologyIndex(
+            uris_by_lex={lex: to_uri(uri) for lex, uri in snapshot['uris_by_lex'].items()},
+            synonyms={to_uri(uri): synonyms for uri, synonyms in snapshot['synonyms'].items()},
+            subclasses={to_uri(uri): [to_uri(item) for item in items] for uri, items in
+                        snapshot['subclasses'].items()},
+            superclasses={to_uri(uri): [to_uri(item) for item in items] for uri, items in
+                          snapshot['superclasses'].items()},
+            source_hash=snapshot.get('source_hash'),
+        )
+
+    def __repr__(self):
+        return f"OntologyIndex({len(self.uris_by_lex)} lexicalisations, {len(self.synonyms)} concepts)"
+
+
+def find_synonyms_for(resource: URIRef, ontology: Graph | OntologyIndex) -> list[str]:
+    if isinstance(ontology, OntologyIndex):
+        return ontology.synonyms.get(resource, [])
+
+    lex = [str(item[2]) for item in ontology.triples((resource, LEX, None))]
     return lex
 
 
-def find_uri_for(lex: str, ontology: Graph) -> URIRef | None:
-    if lex == '"':
-        return None
+def find_uri_for(lex: str, ontology: Graph | OntologyIndex) -> URIRef | None:
+    if isinstance(ontology, OntologyIndex):
+        return ontology.uris_by_lex.get(lex)
 
-    result = ontology.query(f"""
-                SELECT ?subject
-                {{ ?subject restaurant1:lex "{lex}" }}
-                LIMIT 1
-                """)
-    for row in result:
-        return row.subject
+    for subject in ontology.subjects(LEX, Literal(lex)):
+        return subject
     return None
+
+
+def find_subclasses_of(resource: URIRef, ontology: Graph | OntologyIndex) -> list[URIRef]:
+    if isinstance(ontology, OntologyIndex):
+        return ontology.subclasses.get(resource, [])
+
+    return [subclass for subclass, _, _ in ontology.triples((None, RDFS.subClassOf, resource)) if
+            isinstance(subclass, URIRef)]
+
+
+def find_superclasses_of(resource: URIRef, ontology: Graph | OntologyIndex) -> list[URIRef]:
+    if isinstance(ontology, OntologyIndex):
+        return ontology.superclasses.get(resource, [])
+
+    return [superclass for _, _, superclass in ontology.triples((resource, RDFS.subClassOf, None)) if
+            isinstance(superclass, URIRef)]
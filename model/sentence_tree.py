@@ -1,12 +1,15 @@
-from dataclasses import dataclass
+import heapq
+from dataclasses import dataclass, field
+from typing import Optional
 
 import torch
-from rdflib import Graph, URIRef, RDFS
+from rdflib import Graph, URIRef
 from collections import deque
 
-from transformers import BertTokenizer
+from transformers import BertTokenizer, BertTokenizerFast
 
-from .ontology import find_synonyms_for, find_uri_for
+from .ontology import OntologyIndex, find_synonyms_for, find_uri_for, find_subclasses_of, find_superclasses_of
+from .tokenization import TokenizedSentence
 
 
 @dataclass
@@ -121,14 +124,58 @@ class SentenceTreeEmbedding:
     target_end: int
     hops: torch.Tensor
     vm: torch.Tensor
+    """[n x n] boolean visible matrix, True if two tokens can see each other"""
+
+
+def build_visible_matrix(size: int, root_positions: list[int], rows: list[int], cols: list[int]) -> torch.Tensor:
+    """Build a symmetric visible matrix in which every token can see itself, all tokens at root_positions can see
+    each other and each pair (rows[k], cols[k]) can see each other.
+
+    :return: [size x size] boolean matrix, True for visible and False for invisible tokens
+    """
+    # without inserted knowledge, all tokens can see each other
+    if len(root_positions) == size:
+        return torch.ones(size, size, dtype=torch.bool)
+
+    vm = torch.zeros(size, size, dtype=torch.bool)
+    vm.fill_diagonal_(True)
+
+    # words in the root sentence can see each other
+    root_index = torch.tensor(root_positions, dtype=torch.long)
+    vm[root_index.unsqueeze(1), root_index.unsqueeze(0)] = True
+
+    rows_index = torch.tensor(rows, dtype=torch.long)
+    cols_index = torch.tensor(cols, dtype=torch.long)
+    vm[rows_index, cols_index] = True
+    vm[cols_index, rows_index] = True
+
+    return vm
+
+
+def merge_word_parts(tokens: list[str]) -> list[list[str]]:
+    """Group the tokens of the BERT tokenizer into words, a token that starts with ## belongs to the previous word."""
+    result: list[list[str]] = []
+
+    for token in tokens:
+        if not token.startswith("##") or len(result) == 0:
+            result.append([token])
+        else:
+            result[-1].append(token)
+
+    return result
 
 
 class SentenceTree:
     """A SentenceTree can be used to insert knowledge from an ontology into a sentence. A SentenceTree creates a node
     for each word (token) in a sentence, it inserts additional information from the ontology into the tree."""
 
-    def __init__(self, sentence: str, target_start: int, target_end: int, ontology: Graph, tokenizer: BertTokenizer,
-                 device: torch.device | str | int | None, hops=0, include_subclasses=True, include_superclasses=False):
+    def __init__(self, sentence: str, target_start: int, target_end: int, ontology: Graph | OntologyIndex,
+                 tokenizer: BertTokenizer | BertTokenizerFast, device: torch.device | str | int | None, hops=0,
+                 include_subclasses=True, include_superclasses=False):
+        """
+        :param ontology: the ontology, use an OntologyIndex when building many trees, as the lookups in a Graph are
+                         much slower
+        """
         self.ontology = ontology
         self.tokenizer = tokenizer
         self.device = device
@@ -140,29 +187,18 @@ class SentenceTree:
 
         i = 0
         # append left context
-        for token in self.__merge_word_parts(tokenizer.tokenize(sentence[0:target_start])):
+        for token in merge_word_parts(tokenizer.tokenize(sentence[0:target_start])):
             self.__append_root_node(token, i)
             i += 1
         # append target
-        for token in self.__merge_word_parts(tokenizer.tokenize(sentence[target_start:target_end])):
+        for token in merge_word_parts(tokenizer.tokenize(sentence[target_start:target_end])):
             self.__append_root_node(token, i, True)
             i += 1
         # append right context
-        for token in self.__merge_word_parts(tokenizer.tokenize(sentence[target_end:])):
+        for token in merge_word_parts(tokenizer.tokenize(sentence[target_end:])):
             self.__append_root_node(token, i)
             i += 1
 
-    def __merge_word_parts(self, tokens: list[str]):
-        result: deque[list[str]] = deque()
-
-        for token in tokens:
-            if not token.startswith("##"):
-                result.append([token])
-            else:
-                result[-1].append(token)
-
-        return result
-
     def __append_root_node(self, tokens: list[str], soft_position: int, is_target=False):
         lex = self.tokenizer.convert_tokens_to_string(tokens)
         uri = find_uri_for(lex, self.ontology)
@@ -213,41 +249,28 @@ class SentenceTree:
         if current_hop >= self.__hops or uri is None or not isinstance(uri, URIRef):
             return
 
+        target_uris: list[URIRef] = []
         # iterate subclasses
         if self.__include_subclasses:
-            for target_uri, _, _ in self.ontology.triples((None, RDFS.subClassOf, uri)):
-                if target_uri is None or not isinstance(target_uri, URIRef) or (
-                        node.get_parent() is not None and node.get_parent().uri == target_uri):
-                    continue
-
-                synonyms = find_synonyms_for(target_uri, self.ontology)
-
-                if len(synonyms) == 0:
-                    continue
-
-                # append synonyms, and recursively call this function on last synonym
-                lex = synonyms[-1]
-                new_node = self.__append_node(lex, node, target_uri)
-                self.__append_synonyms(new_node, synonyms, lex, target_uri)
-                self.__construct_subtree(new_node, current_hop + 1)
-
+            target_uris += find_subclasses_of(uri, self.ontology)
         # iterate superclasses
         if self.__include_superclasses:
-            for _, _, target_uri in self.ontology.triples((uri, RDFS.subClassOf, None)):
-                if target_uri is None or not isinstance(target_uri, URIRef) or (
-                        node.get_parent() is not None and node.get_parent().uri == target_uri):
-                    continue
+            target_uris += find_superclasses_of(uri, self.ontology)
 
-                synonyms = find_synonyms_for(target_uri, self.ontology)
+        for target_uri in target_uris:
+            if node.get_parent() is not None and node.get_parent().uri == target_uri:
+                continue
 
-                if len(synonyms) == 0:
-                    continue
+            synonyms = find_synonyms_for(target_uri, self.ontology)
 
-                # append synonyms, and recursively call this function on last synonym
-                lex = synonyms[-1]
-                new_node = self.__append_node(lex, node, target_uri)
-                self.__append_synonyms(new_node, synonyms, lex, target_uri)
-                self.__construct_subtree(new_node, current_hop + 1)
+            if len(synonyms) == 0:
+                continue
+
+            # append synonyms, and recursively call this function on last synonym
+            lex = synonyms[-1]
+            new_node = self.__append_node(lex, node, target_uri)
+            self.__append_synonyms(new_node, synonyms, lex, target_uri)
+            self.__construct_subtree(new_node, current_hop + 1)
 
     def build_embedding(self) -> SentenceTreeEmbedding:
         """Build this sentence tree into an input representation for the BERT model"""
@@ -280,65 +303,55 @@ class SentenceTree:
             vm=vm)
 
     def __generate_vm_and_target_pos(self) -> tuple[torch.Tensor, int, int]:
-        # initialize n-by-n matrix filled with -inf, note that this matrix will be symmetric
-        vm = torch.zeros(self.__size, self.__size) - torch.inf
-        target_start = self.__size - 1
-        target_end = 0
-
-        # every node can see itself
-        for i in range(self.__size):
-            vm[i][i] = 0
-
-        def check_target_index(i: int):
-            nonlocal target_start, target_end
-            if i < target_start:
-                target_start = i
-            if i + 1 > target_end:
-                target_end = i + 1
+        """Build the visible matrix from index arrays: all tokens of the root sentence can see each other, and every
+        token of an injected node can see the tokens of its parents, up to (and including) the first parent that is
+        connected by a soft edge. The matrix is symmetric and every token can see itself."""
+        root_positions: list[int] = []
+        target_positions: list[int] = []
+        # the visible (row, column) pairs of the branches
+        rows: list[int] = []
+        cols: list[int] = []
 
         def set_child_visibility(node: Node):
-            for value in node.get_tokens():
-                i = value.hard_position
-                current_parent = node.get_parent()
+            positions = [value.hard_position for value in node.get_tokens()]
+            if node.is_target():
+                target_positions.extend(positions)
 
-                if node.is_target():
-                    check_target_index(i)
+            parent_positions: list[int] = []
+            current_parent = node.get_parent()
+            while current_parent is not None:
+                parent_positions.extend(value.hard_position for value in current_parent.get_tokens())
 
-                while current_parent is not None:
-                    for parent_value in current_parent.get_tokens():
-                        j = parent_value.hard_position
-                        vm[i][j] = 0
-                        vm[j][i] = 0
+                if node.is_soft_edge() or current_parent.is_soft_edge():
+                    break
 
-                    if node.is_soft_edge() or current_parent.is_soft_edge():
-                        break
+                current_parent = current_parent.get_parent()
 
-                    current_parent = current_parent.get_parent()
+            for i in positions:
+                rows.extend([i] * len(parent_positions))
+                cols.extend(parent_positions)
 
             for child in node.get_children():
                 set_child_visibility(child)
 
         for root in self.__nodes:
-            for value in root.get_tokens():
-                i = value.hard_position
-
-                if root.is_target():
-                    check_target_index(i)
-
-                # words in the root sentence can see each other
-                for other_root in self.__nodes:
-                    for other_value in other_root.get_tokens():
-                        j = other_value.hard_position
-                        vm[i][j] = 0
-                        vm[j][i] = 0
+            positions = [value.hard_position for value in root.get_tokens()]
+            root_positions.extend(positions)
+            if root.is_target():
+                target_positions.extend(positions)
 
             for child in root.get_children():
                 set_child_visibility(child)
 
-        if target_start > target_end:
-            raise ValueError("Could not locate the target after inserting knowledge")
+        vm = build_visible_matrix(self.__size, root_positions, rows, cols)
+
+        if len(target_positions) == 0:
+            # a tree of at most one token without a target has an empty target at its last token
+            if self.__size > 1:
+                raise ValueError("Could not locate the target after inserting knowledge")
+            return vm, self.__size - 1, 0
 
-        return vm, target_start, target_end
+        return vm, min(target_positions), max(target_positions) + 1
 
     def __len__(self):
         return self.__size
@@ -346,3 +359,347 @@ class SentenceTree:
     def __repr__(self):
         """Creates a hierarchical string representation of the tree"""
         return '\n'.join([repr(node) for node in self.__nodes])
+
+
+@dataclass
+class KnowledgeSubtree:
+    """The knowledge that is inserted below a target word with a given URI, stored as parallel arrays in depth-first
+    order. Parents are indices into these arrays, -1 refers to the target word itself, and soft positions are relative
+    to the soft position of the target word."""
+    synonyms: list[tuple[str, list[str]]]
+    """the lexical representation and tokens of each synonym of the URI itself, these are inserted before the other
+    nodes, except for the synonym that equals the target word"""
+    tokens: list[list[str]] = field(default_factory=list)
+    soft_offsets: list[list[int]] = field(default_factory=list)
+    parents: list[int] = field(default_factory=list)
+    uris: list[URIRef] = field(default_factory=list)
+    is_soft_edge: list[bool] = field(default_factory=list)
+
+    def append(self, tokens: list[str], soft_offset: int, parent: int, uri: URIRef, is_soft_edge=False) -> int:
+        self.tokens.append(tokens)
+        self.soft_offsets.append([soft_offset + i for i in range(len(tokens))])
+        self.parents.append(parent)
+        self.uris.append(uri)
+        self.is_soft_edge.append(is_soft_edge)
+        return len(self.parents) - 1
+
+    def __len__(self):
+        return len(self.parents)
+
+
+class KnowledgeCache:
+    """Memoizes the knowledge that is inserted below a URI, such that the ontology is walked and the synonyms are
+    tokenized only once per concept, instead of once per occurrence in the corpus. A cache belongs to a single ontology
+    and tokenizer."""
+
+    def __init__(self, ontology: Graph | OntologyIndex, tokenizer: BertTokenizer | BertTokenizerFast):
+        self.ontology = ontology
+        self.tokenizer = tokenizer
+        self.hits = 0
+        self.misses = 0
+        self.__subtrees: dict[tuple[URIRef, int, bool, bool], KnowledgeSubtree] = {}
+        self.__tokens: dict[str, list[str]] = {}
+
+    def get(self, uri: URIRef, hops: int, include_subclasses=True, include_superclasses=False) -> KnowledgeSubtree:
+        key = (uri, hops, include_subclasses, include_superclasses)
+        subtree = self.__subtrees.get(key)
+        if subtree is not None:
+            self.hits += 1
+            return subtree
+
+        self.misses += 1
+        subtree = self.__build(uri, hops, include_subclasses, include_superclasses)
+        self.__subtrees[key] = subtree
+        return subtree
+
+    def tokenize(self, lex: str) -> list[str]:
+        """A lexical representation from the ontology may contain spaces, the value is tokenized once."""
+        tokens = self.__tokens.get(lex)
+        if tokens is None:
+            tokens = [token for token in self.tokenizer.tokenize(lex) if token != '']
+            self.__tokens[lex] = tokens
+        return tokens
+
+    def __build(self, uri: URIRef, hops: int, include_subclasses: bool, include_superclasses: bool):
+        subtree = KnowledgeSubtree(
+            synonyms=[(lex, self.tokenize(lex)) for lex in find_synonyms_for(uri, self.ontology)])
+
+        def construct(node: int, node_uri: URIRef, parent_uri: Optional[URIRef], last_soft_offset: int,
+                      current_hop: int):
+            if current_hop >= hops or node_uri is None or not isinstance(node_uri, URIRef):
+                return
+
+            target_uris: list[URIRef] = []
+            if include_subclasses:
+                target_uris += find_subclasses_of(node_uri, self.ontology)
+            if include_superclasses:
+                target_uris += find_superclasses_of(node_uri, self.ontology)
+
+            for target_uri in target_uris:
+                if parent_uri is not None and parent_uri == target_uri:
+                    continue
+
+                synonyms = find_synonyms_for(target_uri, self.ontology)
+
+                if len(synonyms) == 0:
+                    continue
+
+                # append synonyms, and recursively construct the subtree of the last synonym
+                lex = synonyms[-1]
+                tokens = self.tokenize(lex)
+                new_node = subtree.append(tokens, last_soft_offset + 1, node, target_uri)
+                for synonym in synonyms:
+                    if synonym == lex:
+                        continue
+                    subtree.append(self.tokenize(synonym), last_soft_offset + 1, new_node, target_uri,
+                                   is_soft_edge=True)
+
+                construct(new_node, target_uri, node_uri, last_soft_offset + len(tokens), current_hop + 1)
+
+        construct(-1, uri, None, 0, 0)
+        return subtree
+
+    def __len__(self):
+        return len(self.__subtrees)
+
+    def __repr__(self):
+        return f"KnowledgeCache({len(self)} subtrees, {self.hits} hits, {self.misses} misses)"
+
+
+class FlatSentenceTree:
+    """A FlatSentenceTree inserts the same knowledge as a SentenceTree, but stores the tree in parallel arrays instead
+    of Node and Token objects. The nodes are created in depth-first order, so the tokens are stored in the order of the
+    input sequence and the hard position of a token is its index. The number of hops of a node is computed once, when
+    the node is created. The knowledge below a target word is taken from a KnowledgeCache."""
+
+    def __init__(self, sentence: str, target_start: int, target_end: int, ontology: Graph | OntologyIndex,
+                 tokenizer: BertTokenizer | BertTokenizerFast, device: torch.device | str | int | None, hops=0,
+                 include_subclasses=True, include_superclasses=False, knowledge_cache: Optional[KnowledgeCache] = None,
+                 max_knowledge_tokens: Optional[int] = None, max_target_knowledge_tokens: Optional[int] = None,
+                 max_length: Optional[int] = 512, tokenized: Optional[TokenizedSentence] = None):
+        """
+        :param knowledge_cache: the cache of the inserted knowledge, share a cache between the trees of a corpus to
+                                expand every concept only once
+        :param max_knowledge_tokens: the maximum number of inserted tokens in the sentence, None for no limit
+        :param max_target_knowledge_tokens: the maximum number of inserted tokens below a single target word, None for
+                                            no limit
+        :param max_length: the maximum length of the sequence, knowledge is only inserted up to this length
+        :param tokenized: the tokens of the sentence, including the [CLS] and [SEP] tokens, in which case the target
+                          indices refer to the sentence without these tokens and the sentence is not tokenized again
+        """
+        self.ontology = ontology
+        self.tokenizer = tokenizer
+        self.device = device
+        self.knowledge_cache = knowledge_cache if knowledge_cache is not None else KnowledgeCache(ontology, tokenizer)
+        self.__include_subclasses = include_subclasses
+        self.__include_superclasses = include_superclasses
+        self.__hops = hops
+
+        # token arrays, indexed by hard position
+        self.tokens: list[str] = []
+        self.soft_positions: list[int] = []
+        self.token_nodes: list[int] = []
+
+        # node arrays, indexed by node
+        self.node_parents: list[int] = []
+        """the index of the parent of each node, -1 for the nodes of the root sentence"""
+        self.node_starts: list[int] = []
+        self.node_ends: list[int] = []
+        self.node_hops: list[int] = []
+        self.node_is_target: list[bool] = []
+        self.node_is_soft_edge: list[bool] = []
+        self.node_uris: list[Optional[URIRef]] = []
+
+        # left context, target and right context
+        if tokenized is None:
+            segments = [tokenizer.tokenize(sentence[start:end]) for start, end in
+                        ((0, target_start), (target_start, target_end), (target_end, len(sentence)))]
+        else:
+            span_start, span_end = tokenized.target_span(target_start, target_end)
+            segments = [tokenized.tokens[:span_start], tokenized.tokens[span_start:span_end],
+                        tokenized.tokens[span_end:]]
+
+        words: list[tuple[list[str], bool]] = []
+        for segment, is_target in zip(segments, (False, True, False)):
+            words += [(word, is_target) for word in merge_word_parts(segment)]
+
+        self.__max_target_knowledge_tokens = max_target_knowledge_tokens
+        self.__knowledge_budget = max_knowledge_tokens
+        if max_length is not None:
+            n_root_tokens = sum(len(word) for word, _ in words)
+            length_budget = max(max_length - n_root_tokens, 0)
+            self.__knowledge_budget = length_budget if self.__knowledge_budget is None else \
+                min(self.__knowledge_budget, length_budget)
+
+        self.n_knowledge_tokens = 0
+        """the number of inserted tokens"""
+        self.n_pruned_tokens = 0
+        """the number of tokens that were not inserted because of the budget"""
+        self.n_pruned_nodes = 0
+
+        for soft_position, (word, is_target) in enumerate(words):
+            self.__append_root_node(word, soft_position, is_target)
+
+    def __append(self, tokens: list[str], soft_positions: list[int], parent: int, uri: Optional[URIRef],
+                 is_soft_edge=False, is_target=False) -> int:
+        if len(tokens) == 0:
+            raise ValueError("A node cannot have no values")
+
+        node = len(self.node_parents)
+        if parent == -1:
+            n_hops = -1
+        else:
+            is_target = self.node_is_target[parent]
+            n_hops = max(self.node_hops[parent], 0) + (0 if is_soft_edge else 1)
+
+        self.node_parents.append(parent)
+        self.node_starts.append(len(self.tokens))
+        self.node_hops.append(n_hops)
+        self.node_is_target.append(is_target)
+        self.node_is_soft_edge.append(is_soft_edge)
+        self.node_uris.append(uri)
+
+        self.tokens.extend(tokens)
+        self.soft_positions.extend(soft_positions)
+        self.token_nodes.extend([node] * len(tokens))
+        self.node_ends.append(len(self.tokens))
+
+        return node
+
+    def __append_root_node(self, tokens: list[str], soft_position: int, is_target: bool):
+        lex = self.tokenizer.convert_tokens_to_string(tokens)
+        uri = find_uri_for(lex, self.ontology)
+        node = self.__append(tokens, [soft_position] * len(tokens), -1, uri, is_target=is_target)
+
+        if uri is None or not is_target:
+            return
+
+        subtree = self.knowledge_cache.get(uri, self.__hops, self.__include_subclasses, self.__include_superclasses)
+        synonyms = [synonym_tokens for synonym, synonym_tokens in subtree.synonyms if synonym != lex]
+        selected = self.__select_knowledge(synonyms, subtree)
+
+        for i, synonym_tokens in enumerate(synonyms):
+            if not selected[i]:
+                continue
+            self.__append(synonym_tokens, [soft_position + j for j in range(len(synonym_tokens))], node, uri,
+                          is_soft_edge=True)
+
+        # splice the cached subtree into this tree
+        nodes: list[int] = []
+        for i in range(len(subtree)):
+            if not selected[len(synonyms) + i]:
+                # keep the indices aligned with the subtree, the children of a pruned node are pruned as well
+                nodes.append(-1)
+                continue
+
+            parent = node if subtree.parents[i] == -1 else nodes[subtree.parents[i]]
+            soft_positions = [soft_position + offset for offset in subtree.soft_offsets[i]]
+            nodes.append(self.__append(subtree.tokens[i], soft_positions, parent, subtree.uris[i],
+                                       subtree.is_soft_edge[i]))
+
+    def __select_knowledge(self, synonyms: list[list[str]], subtree: KnowledgeSubtree) -> list[bool]:
+        """Select the synonyms and subtree nodes that fit within the remaining budget. The nodes are selected greedily
+        in order of priority, nearer hops first and synonyms before other nodes with the same hops, and a node is only
+        considered once its parent is selected.
+
+        :return: for each synonym and then each node of the subtree, whether it is inserted
+        """
+        n_synonyms = len(synonyms)
+        tokens = synonyms + subtree.tokens
+        n_tokens = sum(len(item) for item in tokens)
+        budget = self.__knowledge_budget
+        if self.__max_target_knowledge_tokens is not None:
+            budget = self.__max_target_knowledge_tokens if budget is None else \
+                min(budget, self.__max_target_knowledge_tokens)
+
+        if budget is None or n_tokens <= budget:
+            if self.__knowledge_budget is not None:
+                self.__knowledge_budget -= n_tokens
+            self.n_knowledge_tokens += n_tokens
+            return [True] * len(tokens)
+
+        # the synonyms of the target word are soft children at hop 0
+        parents = [-1] * n_synonyms + [-1 if parent == -1 else n_synonyms + parent for parent in subtree.parents]
+        is_soft_edge = [True] * n_synonyms + subtree.is_soft_edge
+        hops: list[int] = []
+        children: list[list[int]] = [[] for _ in tokens]
+        heap: list[tuple[int, bool, int]] = []
+        for i, parent in enumerate(parents):
+            hops.append((0 if parent == -1 else hops[parent]) + (0 if is_soft_edge[i] else 1))
+            if parent == -1:
+                heap.append((hops[i], not is_soft_edge[i], i))
+            else:
+                children[parent].append(i)
+        heapq.heapify(heap)
+
+        selected = [False] * len(tokens)
+        used = 0
+        while len(heap) > 0:
+            _, _, i = heapq.heappop(heap)
+            if used + len(tokens[i]) > budget:
+                continue
+
+            selected[i] = True
+            used += len(tokens[i])
+            for child in children[i]:
+                heapq.heappush(heap, (hops[child], not is_soft_edge[child], child))
+
+        if self.__knowledge_budget is not None:
+            self.__knowledge_budget -= used
+        self.n_knowledge_tokens += used
+        self.n_pruned_tokens += n_tokens - used
+        self.n_pruned_nodes += selected.count(False)
+        return selected
+
+    def build_embedding(self) -> SentenceTreeEmbedding:
+        """Build this sentence tree into an input representation for the BERT model"""
+        root_positions: list[int] = []
+        target_positions: list[int] = []
+        rows: list[int] = []
+        cols: list[int] = []
+
+        for node, parent in enumerate(self.node_parents):
+            positions = range(self.node_starts[node], self.node_ends[node])
+            if self.node_is_target[node]:
+                target_positions.extend(positions)
+
+            if parent == -1:
+                root_positions.extend(positions)
+                continue
+
+            # a node can see its parents up to (and including) the first parent that is connected by a soft edge
+            parent_positions: list[int] = []
+            while parent != -1:
+                parent_positions.extend(range(self.node_starts[parent], self.node_ends[parent]))
+
+                if self.node_is_soft_edge[node] or self.node_is_soft_edge[parent]:
+                    break
+
+                parent = self.node_parents[parent]
+
+            for i in positions:
+                rows.extend([i] * len(parent_positions))
+                cols.extend(parent_positions)
+
+        if len(target_positions) > 0:
+            target_start, target_end = min(target_positions), max(target_positions) + 1
+        elif len(self.tokens) <= 1:
+            # as in SentenceTree, a tree of at most one token without a target has an empty target at its last token
+            target_start, target_end = len(self.tokens) - 1, 0
+        else:
+            raise ValueError("Could not locate the target after inserting knowledge")
+
+        node_hops = torch.tensor(self.node_hops, dtype=torch.long)
+
+        return SentenceTreeEmbedding(
+            tokens=list(self.tokens),
+            input_ids=torch.tensor([self.tokenizer.convert_tokens_to_ids(self.tokens)], device=self.device),
+            position_ids=torch.tensor([self.soft_positions], device=self.device),
+            token_type_ids=torch.zeros(1, len(self.tokens), dtype=torch.long, device=self.device),
+            target_start=target_start,
+            target_end=target_end,
+            hops=node_hops[torch.tensor(self.token_nodes, dtype=torch.long)],
+            vm=build_visible_matrix(len(self.tokens), root_positions, rows, cols))
+
+    def __len__(self):
+        return len(self.tokens)
@@ -0,0 +1,93 @@
+import os
+import pickle
+from dataclasses import dataclass
+from typing import Optional
+
+from transformers import PreTrainedTokenizerFast
+
+
+@dataclass
+class TokenizedSentence:
+    """The tokens of a sentence, including the [CLS] and [SEP] tokens."""
+    tokens: list[str]
+    input_ids: list[int]
+    offsets: list[tuple[int, int]]
+    """the start and end character index of each token in the sentence, (0, 0) for the special tokens"""
+
+    def target_span(self, target_start: int, target_end: int) -> tuple[int, int]:
+        """Returns the start and end index of the tokens of the target, the indices include the [CLS] token.
+
+        :param target_start: the start character index of the target in the sentence
+        :param target_end: the end character index of the target in the sentence
+        """
+        last = len(self.tokens) - 1
+
+        start = 1
+        while start < last and self.offsets[start][0] < target_start:
+            start += 1
+        end = start
+        while end < last and self.offsets[end][0] < target_end:
+            end += 1
+
+        return start, end
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class TokenizationCache:
+    """Stores the tokenized sentences of a corpus, such that every sentence is tokenized only once. Missing sentences
+    are tokenized using a single call to a fast tokenizer. The cache can be saved to disk, such that later runs skip the
+    tokenization entirely, it is cleared automatically when it is used with a different tokenizer."""
+
+    def __init__(self, path: Optional[str] = None):
+        """
+        :param path: the file the cache is loaded from and saved to, None to keep the cache in memory
+        """
+        self.path = path
+        self.tokenizer_name: Optional[str] = None
+        self.__sentences: dict[str, TokenizedSentence] = {}
+        self.__changed = False
+
+        if path is not None and os.path.isfile(path):
+            with open(path, "rb") as f:
+                data: dict = pickle.load(f)
+            self.tokenizer_name = data['tokenizer']
+            self.__sentences = data['sentences']
+
+    def tokenize(self, sentences: list[str], tokenizer: PreTrainedTokenizerFast) -> dict[str, TokenizedSentence]:
+        """Returns the tokenized sentence for each of the sentences."""
+        if self.tokenizer_name != tokenizer.name_or_path:
+            self.tokenizer_name = tokenizer.name_or_path
+            self.__sentences.clear()
+
+        missing = list(dict.fromkeys(sentence for sentence in sentences if sentence not in self.__sentences))
+        if len(missing) > 0:
+            encodings = tokenizer(missing, return_offsets_mapping=True)
+            for i, sentence in enumerate(missing):
+                self.__sentences[sentence] = TokenizedSentence(
+                    tokens=encodings.tokens(i),
+                    input_ids=encodings['input_ids'][i],
+                    offsets=[(int(start), int(end)) for start, end in encodings['offset_mapping'][i]]
+                )
+            self.__changed = True
+
+        return {sentence: self.__sentences[sentence] for sentence in sentences}
+
+    def save(self):
+        """Save the cache to its path, if sentences were added since it was loaded."""
+        if self.path is None or not self.__changed:
+            return
+
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f"{self.path}.tmp", "wb") as f:
+            pickle.dump({'tokenizer': self.tokenizer_name, 'sentences': self.__sentences}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{self.path}.tmp", self.path)
+        self.__changed = False
+
+    def __contains__(self, sentence: str):
+        return sentence in self.__sentences
+
+    def __len__(self):
+        return len(self.__sentences)
@@ -0,0 +1,62 @@
+import pytest
+import torch
+from rdflib import URIRef
+from transformers import BertConfig, BertModel, BertTokenizer
+
+from model.ontology import NAMESPACE, OntologyIndex
+
+VOCAB = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', 'the', 'a', 'food', 'meal', 'was', 'great', 'nice', 'good',
+         'pasta', 'noodles', 'spaghetti', 'dish', 'service', 'staff', 'waiters', '##s', '.']
+"""The vocabulary of the tokenizer and model of the tests"""
+
+HIDDEN_SIZE = 16
+"""The hidden size of the model of the tests"""
+
+
+@pytest.fixture(scope='session')
+def vocab_path(tmp_path_factory) -> str:
+    path = tmp_path_factory.mktemp('vocab') / 'vocab.txt'
+    path.write_text('\n'.join(VOCAB) + '\n')
+    return str(path)
+
+
+@pytest.fixture(scope='session')
+def tokenizer(vocab_path: str) -> BertTokenizer:
+    return BertTokenizer(vocab_path)
+
+
+@pytest.fixture(scope='session')
+def model_dir(tmp_path_factory, vocab_path: str) -> str:
+    """A small randomly initialised BERT model with two layers, which can be loaded by EmbeddingsLayer."""
+    path = tmp_path_factory.mktemp('model')
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=len(VOCAB), hidden_size=HIDDEN_SIZE, num_hidden_layers=2, num_attention_heads=2,
+                        intermediate_size=2 * HIDDEN_SIZE, max_position_embeddings=64)
+    BertModel(config).save_pretrained(str(path))
+    (path / 'vocab.txt').write_text('\n'.join(VOCAB) + '\n')
+    return str(path)
+
+
+def uri(name: str) -> URIRef:
+    return URIRef(f"#{name}", NAMESPACE)
+
+
+FOOD, PASTA, SPAGHETTI, DISH, SERVICE, STAFF = (uri(name) for name in
+                                                ['Food', 'Pasta', 'Spaghetti', 'Dish', 'Service', 'Staff'])
+
+
+@pytest.fixture(scope='session')
+def ontology() -> OntologyIndex:
+    """A small ontology of food and service concepts, in which all lexicalisations are in VOCAB."""
+    synonyms = {
+        FOOD: ['food', 'meal'],
+        PASTA: ['noodles', 'pasta'],
+        SPAGHETTI: ['spaghetti'],
+        DISH: ['dish'],
+        SERVICE: ['service'],
+        STAFF: ['waiters', 'staff'],
+    }
+    subclasses = {FOOD: [PASTA, DISH], PASTA: [SPAGHETTI], SERVICE: [STAFF]}
+    superclasses = {PASTA: [FOOD], DISH: [FOOD], SPAGHETTI: [PASTA], STAFF: [SERVICE]}
+    uris_by_lex = {lex: concept for concept, items in synonyms.items() for lex in items}
+    return OntologyIndex(uris_by_lex, synonyms, subclasses, superclasses)
@@ -0,0 +1,126 @@
+import glob
+import os
+
+import pytest
+import torch
+
+from main_embed import write_embedding_variants
+from model import EmbeddingsLayer, OntologyIndex
+from utils import ContentAddressedStore, EmbeddingsStore, EmbeddingsStoreView, open_store
+
+from .conftest import HIDDEN_SIZE
+
+SENTENCES = [
+    [('the food was great', 4, 8, 2, 's1')],
+    [('the service was nice', 4, 11, 1, 's2'), ('the service was nice', 16, 20, 0, 's2')],
+    [('a meal', 2, 6, 0, 's3')],
+    [('the pasta was good', 4, 9, 2, 's4')],
+]
+
+
+@pytest.fixture
+def layer(model_dir: str, ontology: OntologyIndex) -> EmbeddingsLayer:
+    return EmbeddingsLayer(hops=1, ontology=ontology, model_name=model_dir, pooling_layers=(0, 1))
+
+
+def put_items(store: ContentAddressedStore, n_items: int) -> list[torch.Tensor]:
+    torch.manual_seed(0)
+    embeddings = []
+    for i in range(n_items):
+        item = torch.randn(3, HIDDEN_SIZE)
+        store.put(f"key-{i}", item, i % 3, (1, 2), sentence_id=f"s{i}")
+        embeddings.append(item)
+    return embeddings
+
+
+def test_put_flush_and_reopen(tmp_path):
+    store = ContentAddressedStore(str(tmp_path), chunk_size=2)
+    embeddings = put_items(store, 3)
+    store.flush()
+
+    reopened = ContentAddressedStore(str(tmp_path))
+    assert len(reopened) == 3
+    assert len(glob.glob(f"{tmp_path}/*/keys.json")) == 2
+    for i, expected in enumerate(embeddings):
+        assert f"key-{i}" in reopened
+        assert reopened.location(f"key-{i}") == store.location(f"key-{i}")
+
+        chunk_path, row = reopened.location(f"key-{i}")
+        values, label, target_pos, hops = EmbeddingsStore(chunk_path)[row]
+        assert torch.equal(values, expected)
+        assert (label, target_pos, hops) == (i % 3, (1, 2), None)
+
+
+def test_incomplete_chunks(tmp_path):
+    store = ContentAddressedStore(str(tmp_path), chunk_size=2)
+    put_items(store, 3)
+    # a chunk without keys.json that was left behind by an earlier version
+    os.makedirs(f"{tmp_path}/orphan")
+
+    # the third item is in an incomplete chunk, which is not part of the store
+    assert len(glob.glob(f"{tmp_path}/*.tmp")) == 1
+    reopened = ContentAddressedStore(str(tmp_path))
+    assert len(reopened) == 2
+    assert "key-2" not in reopened
+
+    assert ContentAddressedStore.remove_incomplete(str(tmp_path)) == 2
+    assert glob.glob(f"{tmp_path}/*.tmp") == []
+    assert not os.path.isdir(f"{tmp_path}/orphan")
+    assert len(ContentAddressedStore(str(tmp_path))) == 2
+
+
+def test_key_with_different_labels(tmp_path, layer: EmbeddingsLayer):
+    # the same opinion with two labels has a single key, but both labels are kept in the view
+    sentences = [[('the food was great', 4, 8, 0, 's1'), ('the food was great', 4, 8, 2, 's2')]]
+    store = ContentAddressedStore(f"{tmp_path}/cache")
+    write_embedding_variants(layer, sentences, {(True, True): f"{tmp_path}/view"}, progress=False,
+                             content_store=store)
+
+    view = open_store(f"{tmp_path}/view")
+    assert isinstance(view, EmbeddingsStoreView)
+    assert len(store) == 1
+    assert view.labels.tolist() == [0, 2]
+    assert view[0][1] == 0 and view[1][1] == 2
+    assert torch.equal(view[0][0], view[1][0])
+
+
+@pytest.mark.parametrize('precision', ['float32', 'int8'])
+def test_view_matches_store(tmp_path, layer: EmbeddingsLayer, precision: str):
+    variants = [(True, True), (False, True)]
+    store_dirs = {variant: f"{tmp_path}/store-{i}" for i, variant in enumerate(variants)}
+    view_dirs = {variant: f"{tmp_path}/view-{i}" for i, variant in enumerate(variants)}
+
+    write_embedding_variants(layer, SENTENCES, store_dirs, precision, batch_size=2, progress=False)
+    write_embedding_variants(layer, SENTENCES, view_dirs, precision, batch_size=2, progress=False,
+                             content_store=ContentAddressedStore(f"{tmp_path}/cache", precision, chunk_size=3))
+
+    for variant in variants:
+        store = open_store(store_dirs[variant])
+        view = open_store(view_dirs[variant])
+        assert isinstance(store, EmbeddingsStore) and isinstance(view, EmbeddingsStoreView)
+        assert view.precision == precision
+        assert len(view) == len(store) == 5
+        assert view.get_lengths() == store.get_lengths()
+
+        for i in range(len(store)):
+            embeddings, label, target_pos, hops = store[i]
+            view_embeddings, view_label, view_target_pos, view_hops = view[i]
+            assert torch.equal(view_embeddings, embeddings)
+            assert (view_label, view_target_pos) == (label, target_pos)
+            assert torch.equal(view_hops, hops)
+
+
+def test_second_run_encodes_nothing(tmp_path, layer: EmbeddingsLayer, capsys):
+    dirs = {(True, True): f"{tmp_path}/view"}
+
+    write_embedding_variants(layer, SENTENCES, dirs, progress=False,
+                             content_store=ContentAddressedStore(f"{tmp_path}/cache"))
+    assert "5 opinions were encoded" in capsys.readouterr().out
+    chunks = sorted(glob.glob(f"{tmp_path}/cache/*"))
+    labels = open_store(dirs[(True, True)]).labels.tolist()
+
+    write_embedding_variants(layer, SENTENCES, dirs, progress=False,
+                             content_store=ContentAddressedStore(f"{tmp_path}/cache"))
+    assert "0 opinions were encoded" in capsys.readouterr().out
+    assert sorted(glob.glob(f"{tmp_path}/cache/*")) == chunks
+    assert open_store(dirs[(True, True)]).labels.tolist() == labels
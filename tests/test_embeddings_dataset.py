@@ -0,0 +1,103 @@
+import os
+
+import pytest
+import torch
+
+from utils import EmbeddingsDataset, EmbeddingsStoreWriter, EmbeddingsStoreView, composite_languages, embeddings_dir
+
+YEAR = 2016
+EMBEDDING_SIZE = 4
+
+
+def write_store(language: str, labels: list[int], seed: int) -> list[torch.Tensor]:
+    """Write a small EmbeddingsStore for language, returns the embeddings of each opinion."""
+    torch.manual_seed(seed)
+    writer = EmbeddingsStoreWriter(embeddings_dir(YEAR, language), embedding_size=EMBEDDING_SIZE,
+                                   config={'year': YEAR, 'language': language})
+    embeddings = []
+    for i, label in enumerate(labels):
+        item = torch.randn(3 + i, EMBEDDING_SIZE)
+        writer.append(item, label, (1, 2), sentence_id=f"{language}:{i}")
+        embeddings.append(item)
+    writer.close()
+    return embeddings
+
+
+def load(language: str) -> EmbeddingsDataset:
+    return EmbeddingsDataset(YEAR, language, device=torch.device('cpu'), enable_cache=False)
+
+
+@pytest.fixture(autouse=True)
+def working_dir(tmp_path, monkeypatch):
+    # the embeddings directories are relative to the working directory
+    monkeypatch.chdir(tmp_path)
+
+
+def test_composite_languages():
+    assert composite_languages('English') is None
+    assert composite_languages('Multilingual') == ['English', 'Dutch', 'French', 'Spanish']
+    assert composite_languages('XACSforDutch') == ['English', 'DutchTranslated', 'EnglishtoDutchACS',
+                                                   'DutchtoEnglishACS']
+    assert composite_languages('English+Dutch') == ['English', 'Dutch']
+
+
+def test_compose_concatenates_components(capsys):
+    english = write_store('English', [0, 1, 2], seed=0)
+    dutch = write_store('Dutch', [2, 2], seed=1)
+
+    dataset = load('English+Dutch')
+
+    assert EmbeddingsStoreView.exists(dataset.dir)
+    assert not os.path.isfile(f"{dataset.dir}/embeddings.bin")
+    assert len(dataset) == 5
+    assert dataset.get_labels() == [0, 1, 2, 2, 2]
+    assert dataset.manifest['sentence_ids'] == ['English:0', 'English:1', 'English:2', 'Dutch:0', 'Dutch:1']
+    assert dataset.manifest['config']['language'] == 'English+Dutch'
+    assert dataset.get_lengths() == [(1, 1, 1), (1, 1, 2), (1, 1, 3), (1, 1, 1), (1, 1, 2)]
+
+    for i, expected in enumerate(english + dutch):
+        (left, target, right), label, hops = dataset[i]
+        assert torch.equal(torch.cat([left, target, right]), expected)
+        assert int(label) == dataset.get_labels()[i]
+        assert hops is None
+
+    # an unchanged composite is not composed again
+    capsys.readouterr()
+    load('English+Dutch')
+    assert 'Composed' not in capsys.readouterr().out
+
+
+def test_compose_is_rebuilt_after_component_is_regenerated():
+    write_store('English', [0, 1], seed=0)
+    write_store('Dutch', [1], seed=1)
+    assert load('English+Dutch').get_labels() == [0, 1, 1]
+
+    dutch = write_store('Dutch', [2, 0, 0], seed=2)
+    dataset = load('English+Dutch')
+
+    assert len(dataset) == 5
+    assert dataset.get_labels() == [0, 1, 2, 0, 0]
+    assert dataset.manifest['sentence_ids'][2:] == ['Dutch:0', 'Dutch:1', 'Dutch:2']
+    (left, target, right), _, _ = dataset[4]
+    assert torch.equal(torch.cat([left, target, right]), dutch[2])
+
+
+def test_compose_requires_components():
+    write_store('English', [0], seed=0)
+
+    with pytest.raises(ValueError, match='Dutch'):
+        load('English+Dutch')
+
+    assert len(EmbeddingsDataset(YEAR, 'English+Dutch', device=torch.device('cpu'), empty_ok=True)) == 0
+
+
+def test_compose_ignores_incomplete_directory():
+    write_store('English', [0], seed=0)
+    write_store('Dutch', [1], seed=1)
+
+    # left behind by an interrupted write
+    os.makedirs(embeddings_dir(YEAR, 'English+Dutch'))
+    with open(f"{embeddings_dir(YEAR, 'English+Dutch')}/embeddings.bin.tmp", "wb"):
+        pass
+
+    assert load('English+Dutch').get_labels() == [0, 1]
@@ -0,0 +1,19 @@
+import pytest
+
+from model import EmbeddingsLayer
+
+from .conftest import HIDDEN_SIZE
+
+
+def test_encoder_uses_dimensions_of_model(model_dir: str):
+    layer = EmbeddingsLayer(model_name=model_dir, pooling_layers=(0, 1))
+    embeddings, target_pos, hops = layer.forward('the food was great', 4, 8)
+
+    assert embeddings.shape == (4, HIDDEN_SIZE)
+    assert target_pos == (1, 2)
+    assert hops is None
+
+
+def test_pooling_layers_are_checked_against_model(model_dir: str):
+    with pytest.raises(ValueError, match='2 layers'):
+        EmbeddingsLayer(model_name=model_dir, pooling_layers=(8, 9, 10, 11))
@@ -0,0 +1,77 @@
+import pytest
+import torch
+
+from utils import EmbeddingsStore, EmbeddingsStoreWriter, EmbeddingsStoreView, merge_stores, write_view, open_store
+from utils.embeddings_store import read_manifest
+
+EMBEDDING_SIZE = 4
+
+
+def write_store(path: str, n_opinions: int, seed: int, precision='float32', with_hops=False) -> list[torch.Tensor]:
+    """Write a small EmbeddingsStore to path, returns the embeddings of each opinion."""
+    torch.manual_seed(seed)
+    embeddings = []
+    with EmbeddingsStoreWriter(path, embedding_size=EMBEDDING_SIZE, precision=precision) as writer:
+        for i in range(n_opinions):
+            item = torch.randn(2 + i, EMBEDDING_SIZE)
+            hops = torch.arange(2 + i) if with_hops else None
+            writer.append(item, i % 3, (1, 2), hops, f"{path}:{i}")
+            embeddings.append(item)
+    return embeddings
+
+
+def test_merge_replaces_view(tmp_path):
+    write_store(f"{tmp_path}/a", 2, seed=0)
+    write_store(f"{tmp_path}/b", 3, seed=1)
+    write_store(f"{tmp_path}/c", 3, seed=2)
+
+    dst = f"{tmp_path}/merged"
+    write_view(dst, [(f"{tmp_path}/a", 0), (f"{tmp_path}/a", 1)], [0, 1])
+    assert isinstance(open_store(dst), EmbeddingsStoreView)
+
+    n_opinions = merge_stores([f"{tmp_path}/a", f"{tmp_path}/b", f"{tmp_path}/c"], dst)
+
+    store = open_store(dst)
+    assert n_opinions == 8
+    assert isinstance(store, EmbeddingsStore)
+    assert len(store) == 8
+    assert not EmbeddingsStoreView.exists(dst)
+
+
+@pytest.mark.parametrize('precision', ['float32', 'float16', 'int8'])
+def test_merge_stores(tmp_path, precision: str):
+    paths = [f"{tmp_path}/{name}" for name in ['a', 'b', 'c']]
+    embeddings = []
+    for i, (path, n_opinions) in enumerate(zip(paths, [2, 3, 1])):
+        embeddings += write_store(path, n_opinions, seed=i, precision=precision, with_hops=True)
+    stores = [EmbeddingsStore(path) for path in paths]
+    expected = [store[i] for store in stores for i in range(len(store))]
+
+    dst = f"{tmp_path}/merged"
+    assert merge_stores(paths, dst) == 6
+
+    merged = EmbeddingsStore(dst)
+    manifest = read_manifest(dst)
+    assert len(merged) == 6
+    assert merged.precision == precision
+    assert merged.offsets.tolist() == [0, 2, 5, 7, 10, 14, 16]
+    assert merged.get_lengths() == [lengths for store in stores for lengths in store.get_lengths()]
+    assert manifest['sentence_ids'] == [f"{path}:{i}" for path, n in zip(paths, [2, 3, 1]) for i in range(n)]
+    assert manifest['labels'] == merged.labels.tolist() == [0, 1, 0, 1, 2, 0]
+    if precision == 'int8':
+        assert len(merged.scales) == 16
+
+    for i, (expected_embeddings, label, target_pos, hops) in enumerate(expected):
+        merged_embeddings, merged_label, merged_target_pos, merged_hops = merged[i]
+        assert torch.equal(merged_embeddings, expected_embeddings)
+        assert (merged_label, merged_target_pos) == (label, target_pos)
+        assert torch.equal(merged_hops, hops)
+        assert torch.allclose(merged_embeddings, embeddings[i], atol=0.05)
+
+
+def test_merge_stores_with_different_precision(tmp_path):
+    write_store(f"{tmp_path}/a", 2, seed=0, precision='float32')
+    write_store(f"{tmp_path}/b", 2, seed=1, precision='int8')
+
+    with pytest.raises(ValueError, match='int8'):
+        merge_stores([f"{tmp_path}/a", f"{tmp_path}/b"], f"{tmp_path}/merged")
@@ -0,0 +1,156 @@
+import os
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+
+import pytest
+import torch
+
+from main_embed import generate_embedding_variants, generate_embeddings_parallel, run_generation, run_pipeline, \
+    write_embedding_variants, read_opinions
+from model import EmbeddingsLayer, OntologyIndex, TokenizationCache
+from utils import EmbeddingsStore
+
+SENTENCES = [
+    ('the food was great', [(4, 8, 'positive')]),
+    ('the service was nice', [(4, 11, 'neutral'), (16, 20, 'negative')]),
+    ('a meal', [(2, 6, 'negative')]),
+    ('the pasta was good', [(4, 9, 'positive')]),
+    ('the staff was nice', [(4, 9, 'positive')]),
+]
+
+
+def make_data(sentences: list[tuple[str, list[tuple[int, int, str]]]]) -> ElementTree.ElementTree:
+    root = ElementTree.Element('Reviews')
+    for i, (text, opinions) in enumerate(sentences):
+        sentence = ElementTree.SubElement(root, 'sentence', id=f"s{i}")
+        ElementTree.SubElement(sentence, 'text').text = text
+        opinions_node = ElementTree.SubElement(sentence, 'Opinions')
+        for target_from, target_to, polarity in opinions:
+            ElementTree.SubElement(opinions_node, 'Opinion', {'from': str(target_from), 'to': str(target_to),
+                                                              'polarity': polarity})
+    return ElementTree.ElementTree(root)
+
+
+def assert_same_stores(path: str, expected_path: str):
+    store, expected = EmbeddingsStore(path), EmbeddingsStore(expected_path)
+    assert len(store) == len(expected)
+    assert store.labels.tolist() == expected.labels.tolist()
+    for i in range(len(expected)):
+        embeddings, label, target_pos, hops = store[i]
+        expected_embeddings, expected_label, expected_target_pos, expected_hops = expected[i]
+        assert torch.allclose(embeddings, expected_embeddings, atol=1e-6)
+        assert (label, target_pos) == (expected_label, expected_target_pos)
+        assert torch.equal(hops, expected_hops)
+
+
+@pytest.fixture
+def layer_args(model_dir: str, ontology: OntologyIndex, tmp_path) -> dict:
+    return dict(hops=1, ontology=ontology, model_name=model_dir, pooling_layers=(0, 1),
+                tokenization_cache=TokenizationCache(f"{tmp_path}/tokenized.pkl"))
+
+
+def test_parallel_matches_sequential(tmp_path, layer_args: dict):
+    data = make_data(SENTENCES)
+    variants = {(True, True): f"{tmp_path}/sequential", (False, False): f"{tmp_path}/sequential_no-vm_no-sp"}
+    generate_embedding_variants(EmbeddingsLayer(**{**layer_args, 'tokenization_cache': None}), data, variants)
+
+    parallel = {(True, True): f"{tmp_path}/parallel", (False, False): f"{tmp_path}/parallel_no-vm_no-sp"}
+    generate_embeddings_parallel(layer_args, data, parallel, batch_size=2, n_workers=2)
+
+    for variant in variants:
+        assert_same_stores(parallel[variant], variants[variant])
+        assert not os.path.isdir(f"{parallel[variant]}.shards")
+
+    # the sentences are tokenized and saved by the main process
+    cache = TokenizationCache(f"{tmp_path}/tokenized.pkl")
+    assert all(text in cache for text, _ in SENTENCES)
+
+
+def test_failed_worker_removes_shards(tmp_path, layer_args: dict):
+    with pytest.raises(ValueError, match='pooling layers'):
+        generate_embeddings_parallel({**layer_args, 'pooling_layers': (5,)}, make_data(SENTENCES),
+                                     {(True, True): f"{tmp_path}/parallel"}, n_workers=2)
+
+    assert not os.path.isdir(f"{tmp_path}/parallel.shards")
+
+
+def test_empty_dataset(tmp_path, layer_args: dict):
+    run_generation(layer_args, make_data([]), {(True, True): f"{tmp_path}/empty"}, n_workers=2)
+
+    assert len(EmbeddingsStore(f"{tmp_path}/empty")) == 0
+
+
+def run_in_thread(target, timeout=10.0) -> list[BaseException]:
+    """Run target in a thread, fails if it does not finish within timeout seconds. Returns the raised errors."""
+    errors: list[BaseException] = []
+
+    def run():
+        try:
+            target()
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "the pipeline did not finish"
+    return errors
+
+
+@pytest.mark.parametrize('queue_size', [1, 4])
+def test_pipeline_preserves_order(queue_size: int):
+    results: list[int] = []
+
+    def slow_consume(item: int):
+        time.sleep(0.001 * (item % 3))
+        results.append(item)
+
+    errors = run_in_thread(lambda: run_pipeline(lambda: iter(range(50)), lambda item: item * 2, slow_consume,
+                                                queue_size))
+    assert errors == []
+    assert results == [item * 2 for item in range(50)]
+
+
+@pytest.mark.parametrize('stage', ['produce', 'process', 'consume'])
+def test_pipeline_raises_errors(stage: str):
+    class StageError(Exception):
+        pass
+
+    def produce():
+        for item in range(100):
+            if stage == 'produce' and item == 10:
+                raise StageError()
+            yield item
+
+    def process(item: int):
+        if stage == 'process' and item == 10:
+            raise StageError()
+        return item
+
+    consumed: list[int] = []
+
+    def consume(item: int):
+        if stage == 'consume' and item == 10:
+            raise StageError()
+        consumed.append(item)
+
+    errors = run_in_thread(lambda: run_pipeline(produce, process, consume, queue_size=1))
+    assert len(errors) == 1 and isinstance(errors[0], StageError)
+    # the items after the error are not consumed
+    assert 10 not in consumed and len(consumed) < 100
+
+
+def test_pipeline_writes_same_stores(tmp_path, layer_args: dict):
+    layer = EmbeddingsLayer(**layer_args)
+    sentences = read_opinions(make_data(SENTENCES))
+    write_embedding_variants(layer, sentences, {(True, True): f"{tmp_path}/sequential"}, batch_size=2,
+                             progress=False, queue_size=0)
+    write_embedding_variants(layer, sentences, {(True, True): f"{tmp_path}/pipelined"}, batch_size=2,
+                             progress=False, queue_size=4)
+
+    assert_same_stores(f"{tmp_path}/pipelined", f"{tmp_path}/sequential")
+    for file in ['embeddings.bin', 'manifest.json']:
+        with open(f"{tmp_path}/pipelined/{file}", "rb") as pipelined, \
+                open(f"{tmp_path}/sequential/{file}", "rb") as sequential:
+            assert pipelined.read() == sequential.read()
@@ -0,0 +1,73 @@
+from typing import Optional
+
+import pytest
+import torch
+from transformers import BertConfig, BertLayer
+
+from model.bert_encoder.multi_headed_attn import MultiHeadedAttention
+
+BATCH_SIZE = 2
+SEQ_LENGTH = 6
+HIDDEN_SIZE = 32
+HEADS_NUM = 4
+
+
+def random_visible_matrix() -> torch.Tensor:
+    """Returns a random symmetric [batch_size x 1 x seq_length x seq_length] boolean visible matrix in which every
+    token can see itself."""
+    vm = torch.rand(BATCH_SIZE, 1, SEQ_LENGTH, SEQ_LENGTH) < 0.5
+    vm = vm | vm.transpose(-2, -1)
+    vm[..., torch.arange(SEQ_LENGTH), torch.arange(SEQ_LENGTH)] = True
+    return vm
+
+
+def to_additive(vm: torch.Tensor) -> torch.Tensor:
+    return torch.zeros(vm.shape).masked_fill(~vm, -torch.inf)
+
+
+@pytest.fixture
+def backends() -> tuple[MultiHeadedAttention, MultiHeadedAttention]:
+    torch.manual_seed(0)
+    layer = BertLayer(BertConfig(hidden_size=HIDDEN_SIZE, num_attention_heads=HEADS_NUM,
+                                 intermediate_size=2 * HIDDEN_SIZE))
+    layer.eval()
+
+    # both backends share the weights of the same layer
+    manual = MultiHeadedAttention(HIDDEN_SIZE, HEADS_NUM, 0.0, layer, backend='manual')
+    sdpa = MultiHeadedAttention(HIDDEN_SIZE, HEADS_NUM, 0.0, layer, backend='sdpa')
+    return manual.eval(), sdpa.eval()
+
+
+@pytest.mark.parametrize('mask', ['none', 'additive', 'bool', 'bool_2d'])
+def test_backends_are_equivalent(backends: tuple[MultiHeadedAttention, MultiHeadedAttention], mask: str):
+    manual, sdpa = backends
+    torch.manual_seed(1)
+    hidden = torch.randn(BATCH_SIZE, SEQ_LENGTH, HIDDEN_SIZE)
+
+    vm: Optional[torch.Tensor] = None
+    if mask == 'additive':
+        vm = to_additive(random_visible_matrix())
+    elif mask == 'bool':
+        vm = random_visible_matrix()
+    elif mask == 'bool_2d':
+        vm = random_visible_matrix()[0, 0]
+
+    with torch.no_grad():
+        expected = manual(hidden, hidden, hidden, vm)
+        output = sdpa(hidden, hidden, hidden, vm)
+
+    assert output.shape == (BATCH_SIZE, SEQ_LENGTH, HIDDEN_SIZE)
+    assert torch.allclose(output, expected, atol=1e-5)
+
+
+def test_bool_and_additive_masks_are_equivalent(backends: tuple[MultiHeadedAttention, MultiHeadedAttention]):
+    manual, _ = backends
+    torch.manual_seed(2)
+    hidden = torch.randn(BATCH_SIZE, SEQ_LENGTH, HIDDEN_SIZE)
+    vm = random_visible_matrix()
+
+    with torch.no_grad():
+        expected = manual(hidden, hidden, hidden, to_additive(vm))
+        output = manual(hidden, hidden, hidden, vm)
+
+    assert torch.allclose(output, expected, atol=1e-6)
@@ -0,0 +1,267 @@
+import pytest
+import torch
+from transformers import BertTokenizer, BertTokenizerFast
+
+from model.ontology import OntologyIndex
+from model.sentence_tree import FlatSentenceTree, KnowledgeCache, Node, SentenceTree, SentenceTreeEmbedding
+from model.tokenization import TokenizationCache
+
+from .conftest import FOOD
+
+
+def reference_vm_and_target_pos(nodes: list[Node], size: int) -> tuple[torch.Tensor, int, int]:
+    """The per-node loop that SentenceTree used before the visible matrix was built from index arrays, it returns an
+    additive visible matrix (0 for visible and -inf for invisible tokens)."""
+    vm = torch.zeros(size, size) - torch.inf
+    target_start = size - 1
+    target_end = 0
+
+    for i in range(size):
+        vm[i][i] = 0
+
+    def check_target_index(i: int):
+        nonlocal target_start, target_end
+        if i < target_start:
+            target_start = i
+        if i + 1 > target_end:
+            target_end = i + 1
+
+    def set_child_visibility(node: Node):
+        for value in node.get_tokens():
+            i = value.hard_position
+            current_parent = node.get_parent()
+
+            if node.is_target():
+                check_target_index(i)
+
+            while current_parent is not None:
+                for parent_value in current_parent.get_tokens():
+                    j = parent_value.hard_position
+                    vm[i][j] = 0
+                    vm[j][i] = 0
+
+                if node.is_soft_edge() or current_parent.is_soft_edge():
+                    break
+
+                current_parent = current_parent.get_parent()
+
+        for child in node.get_children():
+            set_child_visibility(child)
+
+    for root in nodes:
+        for value in root.get_tokens():
+            i = value.hard_position
+
+            if root.is_target():
+                check_target_index(i)
+
+            for other_root in nodes:
+                for other_value in other_root.get_tokens():
+                    j = other_value.hard_position
+                    vm[i][j] = 0
+                    vm[j][i] = 0
+
+        for child in root.get_children():
+            set_child_visibility(child)
+
+    if target_start > target_end:
+        raise ValueError("Could not locate the target after inserting knowledge")
+
+    return vm, target_start, target_end
+
+
+def build_tree(sentence: str, target: str, hops: int, ontology: OntologyIndex, tokenizer: BertTokenizer,
+               include_superclasses=False) -> SentenceTree:
+    target_start = sentence.index(target)
+    return SentenceTree(sentence, target_start, target_start + len(target), ontology, tokenizer, 'cpu', hops=hops,
+                        include_superclasses=include_superclasses)
+
+
+TREES = [
+    ('the food was great', 'food', 0, False),
+    ('the food was great', 'food', 1, False),
+    ('the food was great', 'food', 3, False),
+    ('food was great', 'food', 2, False),
+    ('the staff was nice', 'staff', 2, True),
+    ('a nice service', 'service', 2, False),
+    ('the food service was good', 'food service', 2, False),
+    ('the spaghetti was good', 'spaghetti', 2, True),
+]
+"""The sentence, target, hops and include_superclasses of the trees that are compared"""
+
+
+@pytest.mark.parametrize('sentence, target, hops, include_superclasses', TREES)
+def test_vm_matches_reference(ontology: OntologyIndex, tokenizer: BertTokenizer, sentence: str, target: str,
+                              hops: int, include_superclasses: bool):
+    tree = build_tree(sentence, target, hops, ontology, tokenizer, include_superclasses)
+    embedding = tree.build_embedding()
+    vm, target_start, target_end = reference_vm_and_target_pos(list(tree._SentenceTree__nodes), len(tree))
+
+    if hops > 0:
+        assert len(tree) > len(sentence.split()), "the tree should contain injected branches"
+    assert embedding.vm.dtype == torch.bool
+    assert torch.equal(embedding.vm, vm == 0)
+    assert (embedding.target_start, embedding.target_end) == (target_start, target_end)
+
+
+def test_single_token_without_target(ontology: OntologyIndex, tokenizer: BertTokenizer):
+    tree = SentenceTree('food', 0, 0, ontology, tokenizer, 'cpu', hops=1)
+    embedding = tree.build_embedding()
+    vm, target_start, target_end = reference_vm_and_target_pos(list(tree._SentenceTree__nodes), len(tree))
+
+    assert len(tree) == 1
+    assert torch.equal(embedding.vm, vm == 0)
+    assert (embedding.target_start, embedding.target_end) == (target_start, target_end) == (0, 0)
+
+
+def test_missing_target_raises(ontology: OntologyIndex, tokenizer: BertTokenizer):
+    tree = SentenceTree('the food', 0, 0, ontology, tokenizer, 'cpu', hops=1)
+
+    with pytest.raises(ValueError):
+        reference_vm_and_target_pos(list(tree._SentenceTree__nodes), len(tree))
+    with pytest.raises(ValueError):
+        tree.build_embedding()
+
+
+@pytest.fixture(scope='module')
+def fast_tokenizer(vocab_path: str) -> BertTokenizerFast:
+    return BertTokenizerFast(vocab_path)
+
+
+def build_flat_tree(sentence: str, target: str, hops: int, ontology: OntologyIndex, tokenizer: BertTokenizerFast,
+                    include_superclasses=False, tokenized=False, **kwargs) -> FlatSentenceTree:
+    target_start = sentence.index(target)
+    tokenized_sentence = TokenizationCache().tokenize([sentence], tokenizer)[sentence] if tokenized else None
+    return FlatSentenceTree(sentence, target_start, target_start + len(target), ontology, tokenizer, 'cpu',
+                            hops=hops, include_superclasses=include_superclasses, tokenized=tokenized_sentence,
+                            **kwargs)
+
+
+def strip_special_tokens(embedding: SentenceTreeEmbedding) -> SentenceTreeEmbedding:
+    """Remove the [CLS] and [SEP] tokens of a tree that was built from a tokenized sentence."""
+    assert embedding.tokens[0] == '[CLS]' and embedding.tokens[-1] == '[SEP]'
+    assert embedding.hops[0] == embedding.hops[-1] == -1
+    # the special tokens are part of the root sentence
+    assert embedding.vm[0].tolist() == embedding.vm[-1].tolist() == (embedding.hops == -1).tolist()
+
+    return SentenceTreeEmbedding(
+        tokens=embedding.tokens[1:-1],
+        input_ids=embedding.input_ids[:, 1:-1],
+        position_ids=embedding.position_ids[:, 1:-1] - 1,
+        token_type_ids=embedding.token_type_ids[:, 1:-1],
+        target_start=embedding.target_start - 1,
+        target_end=embedding.target_end - 1,
+        hops=embedding.hops[1:-1],
+        vm=embedding.vm[1:-1, 1:-1])
+
+
+def assert_same_embeddings(embedding: SentenceTreeEmbedding, expected: SentenceTreeEmbedding):
+    assert embedding.tokens == expected.tokens
+    assert torch.equal(embedding.input_ids, expected.input_ids)
+    assert torch.equal(embedding.position_ids, expected.position_ids)
+    assert torch.equal(embedding.hops, expected.hops)
+    assert torch.equal(embedding.vm, expected.vm)
+    assert (embedding.target_start, embedding.target_end) == (expected.target_start, expected.target_end)
+
+
+@pytest.mark.parametrize('tokenized', [False, True])
+@pytest.mark.parametrize('sentence, target, hops, include_superclasses', TREES)
+def test_flat_tree_matches_tree(ontology: OntologyIndex, tokenizer: BertTokenizer, fast_tokenizer: BertTokenizerFast,
+                                sentence: str, target: str, hops: int, include_superclasses: bool, tokenized: bool):
+    expected = build_tree(sentence, target, hops, ontology, tokenizer, include_superclasses).build_embedding()
+    flat_tree = build_flat_tree(sentence, target, hops, ontology, fast_tokenizer, include_superclasses, tokenized)
+    embedding = flat_tree.build_embedding()
+    if tokenized:
+        embedding = strip_special_tokens(embedding)
+
+    assert_same_embeddings(embedding, expected)
+    assert flat_tree.n_pruned_tokens == 0
+
+
+def test_flat_tree_single_token_without_target(ontology: OntologyIndex, tokenizer: BertTokenizer,
+                                               fast_tokenizer: BertTokenizerFast):
+    expected = SentenceTree('food', 0, 0, ontology, tokenizer, 'cpu', hops=1).build_embedding()
+    embedding = FlatSentenceTree('food', 0, 0, ontology, fast_tokenizer, 'cpu', hops=1).build_embedding()
+
+    assert_same_embeddings(embedding, expected)
+    assert (embedding.target_start, embedding.target_end) == (0, 0)
+
+    with pytest.raises(ValueError):
+        FlatSentenceTree('the food', 0, 0, ontology, fast_tokenizer, 'cpu', hops=1).build_embedding()
+
+
+def test_knowledge_cache_is_reused(ontology: OntologyIndex, fast_tokenizer: BertTokenizerFast):
+    cache = KnowledgeCache(ontology, fast_tokenizer)
+    sentences = [('the food was great', 'food'), ('a meal', 'meal'), ('the food was great', 'food')]
+
+    for sentence, target in sentences:
+        cached = build_flat_tree(sentence, target, 2, ontology, fast_tokenizer, knowledge_cache=cache)
+        uncached = build_flat_tree(sentence, target, 2, ontology, fast_tokenizer)
+        assert_same_embeddings(cached.build_embedding(), uncached.build_embedding())
+
+    # food and meal are lexicalisations of the same concept
+    assert (len(cache), cache.misses, cache.hits) == (1, 1, 2)
+    assert cache.get(FOOD, 2) is cache.get(FOOD, 2)
+    assert cache.get(FOOD, 1) is not cache.get(FOOD, 2)
+
+
+def inserted_tokens(tree: FlatSentenceTree) -> list[str]:
+    return [token for token, node in zip(tree.tokens, tree.token_nodes) if tree.node_parents[node] != -1]
+
+
+def root_of(tree: FlatSentenceTree, node: int) -> int:
+    while tree.node_parents[node] != -1:
+        node = tree.node_parents[node]
+    return node
+
+
+@pytest.mark.parametrize('budget', range(8))
+@pytest.mark.parametrize('argument', ['max_knowledge_tokens', 'max_target_knowledge_tokens'])
+@pytest.mark.parametrize('sentence, target', [('the food was great', 'food'),
+                                              ('the food service was good', 'food service')])
+def test_knowledge_budget(ontology: OntologyIndex, fast_tokenizer: BertTokenizerFast, sentence: str, target: str,
+                          argument: str, budget: int):
+    unpruned = build_flat_tree(sentence, target, 2, ontology, fast_tokenizer)
+    tree = build_flat_tree(sentence, target, 2, ontology, fast_tokenizer, **{argument: budget})
+    embedding = tree.build_embedding()
+    n_target_words = len(target.split())
+
+    if argument == 'max_knowledge_tokens':
+        assert tree.n_knowledge_tokens <= budget
+    else:
+        assert tree.n_knowledge_tokens <= n_target_words * budget
+        for word in range(n_target_words):
+            root = [node for node, parent in enumerate(tree.node_parents) if parent == -1 and
+                    tree.node_is_target[node]][word]
+            below = [node for node in range(len(tree.node_parents)) if tree.node_parents[node] != -1 and
+                     root_of(tree, node) == root]
+            assert sum(tree.node_ends[node] - tree.node_starts[node] for node in below) <= budget
+
+    assert tree.n_knowledge_tokens + tree.n_pruned_tokens == unpruned.n_knowledge_tokens
+    assert len(inserted_tokens(tree)) == tree.n_knowledge_tokens
+    assert len(tree) == len(sentence.split()) + tree.n_knowledge_tokens
+    assert (tree.n_pruned_nodes == 0) == (tree.n_pruned_tokens == 0)
+    assert embedding.vm.shape == (len(tree), len(tree))
+
+
+def test_knowledge_budget_priority(ontology: OntologyIndex, fast_tokenizer: BertTokenizerFast):
+    unpruned = build_flat_tree('the food was great', 'food', 2, ontology, fast_tokenizer)
+    assert inserted_tokens(unpruned) == ['meal', 'pasta', 'noodles', 'spaghetti', 'dish']
+
+    # the synonym of pasta is kept before dish, which has the same hops, and spaghetti is at a further hop
+    tree = build_flat_tree('the food was great', 'food', 2, ontology, fast_tokenizer, max_target_knowledge_tokens=3)
+    assert inserted_tokens(tree) == ['meal', 'pasta', 'noodles']
+    assert (tree.n_pruned_tokens, tree.n_pruned_nodes) == (2, 2)
+
+    # the children of a node that does not fit are not inserted
+    tree = build_flat_tree('the food was great', 'food', 2, ontology, fast_tokenizer, max_target_knowledge_tokens=1)
+    assert inserted_tokens(tree) == ['meal']
+
+
+@pytest.mark.parametrize('max_length', range(2, 12))
+def test_max_length(ontology: OntologyIndex, fast_tokenizer: BertTokenizerFast, max_length: int):
+    tree = build_flat_tree('the food was great', 'food', 2, ontology, fast_tokenizer, max_length=max_length)
+
+    # knowledge is only inserted up to max_length, the words of the sentence are always kept
+    assert len(tree) == max(min(max_length, 9), 4)
+    assert tree.n_knowledge_tokens + tree.n_pruned_tokens == 5
@@ -1,3 +1,9 @@
 from .download_from_url import download_from_url
-from .embeddings_dataset import EmbeddingsDataset, train_validation_split
+from .embeddings_dataset import EmbeddingsDataset, train_validation_split, pad_batch, collate_padded, \
+    composite_languages, embeddings_dir
 from .csv_writer import CSVWriter
+from .batch_sampler import LengthBucketBatchSampler
+from .embeddings_store import EmbeddingsStore, EmbeddingsStoreWriter, convert_embeddings_dir, convert_store_precision, \
+    merge_stores, PRECISIONS, EmbeddingsStoreView, write_view, merge_views, open_store
+from .embeddings_cache import EmbeddingsCache, DEFAULT_CACHE_BYTES
+from .content_store import ContentAddressedStore, opinion_key
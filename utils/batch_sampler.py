@@ -0,0 +1,65 @@
+import random
+from typing import Iterator, Optional
+
+from torch.utils.data import Sampler, Subset
+
+from .embeddings_dataset import EmbeddingsDataset
+
+
+class LengthBucketBatchSampler(Sampler[list[int]]):
+    """A batch sampler that groups opinions with a similar number of tokens in the left context, target and right
+    context, which reduces the amount of padding in a batch. The opinions are shuffled, split into buckets of
+    batch_size * bucket_size_multiplier opinions, and sorted by length within each bucket. The order of the resulting
+    batches is shuffled again."""
+
+    def __init__(self, dataset: EmbeddingsDataset | Subset, batch_size: int, shuffle=True, drop_last=False,
+                 bucket_size_multiplier=50, seed: Optional[int] = None):
+        super().__init__(dataset)
+
+        if isinstance(dataset, Subset):
+            dataset_lengths = dataset.dataset.get_lengths()
+            self.lengths = [dataset_lengths[i] for i in dataset.indices]
+        else:
+            self.lengths = dataset.get_lengths()
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.seed = seed
+        self.epoch = 0
+
+    def __sort_key(self, i: int):
+        n_left, n_target, n_right = self.lengths[i]
+        return n_left + n_target + n_right, n_left, n_target
+
+    def __iter__(self) -> Iterator[list[int]]:
+        indices = list(range(len(self.lengths)))
+
+        if not self.shuffle:
+            indices.sort(key=self.__sort_key)
+            buckets = [indices]
+        else:
+            rng = random.Random(None if self.seed is None else self.seed + self.epoch)
+            rng.shuffle(indices)
+            buckets = [sorted(indices[i:i + self.bucket_size], key=self.__sort_key) for i in
+                       range(0, len(indices), self.bucket_size)]
+
+        batches: list[list[int]] = []
+        for bucket in buckets:
+            for i in range(0, len(bucket), self.batch_size):
+                batch = bucket[i:i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    continue
+                batches.append(batch)
+
+        if self.shuffle:
+            rng.shuffle(batches)
+            self.epoch += 1
+
+        return iter(batches)
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
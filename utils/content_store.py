@@ -0,0 +1,104 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from typing import Optional
+
+import torch
+
+from .embeddings_store import EmbeddingsStoreWriter
+
+KEYS_FILE = "keys.json"
+
+
+def opinion_key(sentence: str, target_start: int, target_end: int, encoder_id: str, ont_hops: Optional[int],
+                use_vm: bool, use_soft_pos: bool, precision: str) -> str:
+    """Returns the key of the embeddings of an opinion in a ContentAddressedStore, which is a hash of everything that
+    determines the embeddings."""
+    value = json.dumps([sentence, target_start, target_end, encoder_id, ont_hops, use_vm, use_soft_pos, precision])
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+class ContentAddressedStore:
+    """Stores the embeddings of opinions by a key that identifies their content, see opinion_key, such that embeddings
+    that were generated before are never generated again. The embeddings are appended to chunks, which are
+    EmbeddingsStores of at most chunk_size opinions. A chunk is written to a .tmp directory, which is renamed once the
+    chunk is complete, so an interrupted run loses at most one chunk, which can be removed by remove_incomplete.
+    Multiple processes can add to the same store, as every process writes its own chunks."""
+
+    def __init__(self, path: str, precision='float32', chunk_size=1024):
+        self.path = path
+        self.precision = precision
+        self.chunk_size = chunk_size
+
+        # the chunk and row of each key
+        self.__index: dict[str, tuple[str, int]] = {}
+        for keys_path in sorted(glob.glob(f"{path}/*/{KEYS_FILE}")):
+            chunk_path = os.path.dirname(keys_path)
+            if chunk_path.endswith(".tmp"):
+                continue
+            with open(keys_path, "r") as f:
+                for row, key in enumerate(json.load(f)):
+                    self.__index.setdefault(key, (chunk_path, row))
+
+        self.__writer: Optional[EmbeddingsStoreWriter] = None
+        self.__chunk_path: Optional[str] = None
+        self.__pending: list[str] = []
+
+    @staticmethod
+    def remove_incomplete(path: str) -> int:
+        """Remove the incomplete chunks that were left behind by interrupted runs, returns the number of removed chunks.
+        The chunks that other processes are writing are incomplete as well, so this should only be used when no other
+        process is adding to the store at path."""
+        n_removed = 0
+        for chunk_path in glob.glob(f"{path}/*"):
+            if not os.path.isdir(chunk_path):
+                continue
+            if chunk_path.endswith(".tmp") or not os.path.isfile(f"{chunk_path}/{KEYS_FILE}"):
+                shutil.rmtree(chunk_path, ignore_errors=True)
+                n_removed += 1
+
+        return n_removed
+
+    def location(self, key: str) -> Optional[tuple[str, int]]:
+        """Returns the path of the chunk and the row in that chunk of the embeddings with the given key, or None if
+        the key is not in this store. The chunk of a key that was just added is only readable after flush()."""
+        return self.__index.get(key)
+
+    def put(self, key: str, embeddings: torch.Tensor, label: int, target_pos: tuple[int, int],
+            hops: Optional[torch.Tensor] = None, sentence_id: Optional[str] = None):
+        if key in self.__index:
+            return
+
+        if self.__writer is None:
+            self.__chunk_path = f"{self.path}/{uuid.uuid4().hex}"
+            self.__writer = EmbeddingsStoreWriter(f"{self.__chunk_path}.tmp", embedding_size=embeddings.size(1),
+                                                  precision=self.precision)
+        self.__writer.append(embeddings, label, target_pos, hops, sentence_id)
+        self.__index[key] = (self.__chunk_path, len(self.__pending))
+        self.__pending.append(key)
+
+        if len(self.__pending) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        """Complete the current chunk."""
+        if self.__writer is None:
+            return
+
+        self.__writer.close()
+        with open(f"{self.__writer.path}/{KEYS_FILE}", "w") as f:
+            json.dump(self.__pending, f)
+        os.replace(self.__writer.path, self.__chunk_path)
+
+        self.__writer = None
+        self.__chunk_path = None
+        self.__pending = []
+
+    def __contains__(self, key: str):
+        return key in self.__index
+
+    def __len__(self):
+        return len(self.__index)
@@ -0,0 +1,89 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+import torch
+
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+"""The default budget of an EmbeddingsCache (2 GiB)"""
+
+
+def size_of(value: Any) -> int:
+    """Returns the number of bytes of all tensors in a (nested) tuple or list."""
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if isinstance(value, (tuple, list)):
+        return sum(size_of(item) for item in value)
+    return 0
+
+
+class EmbeddingsCache:
+    """A least-recently-used cache for items of an EmbeddingsDataset, which evicts items once the tensors in the cache
+    exceed max_bytes. A single cache can be shared by multiple datasets, as the keys include the embeddings
+    directory."""
+
+    def __init__(self, max_bytes: Optional[int] = DEFAULT_CACHE_BYTES):
+        """
+        :param max_bytes: the maximum number of bytes of the cached tensors, None disables the limit
+        """
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__items: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key not in self.__items:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__items.move_to_end(key)
+        value, _ = self.__items[key]
+        return value
+
+    def put(self, key: Hashable, value: Any):
+        n_bytes = size_of(value)
+
+        # items that exceed the budget on their own are not cached
+        if self.max_bytes is not None and n_bytes > self.max_bytes:
+            return
+
+        if key in self.__items:
+            _, old_n_bytes = self.__items.pop(key)
+            self.n_bytes -= old_n_bytes
+
+        self.__items[key] = (value, n_bytes)
+        self.n_bytes += n_bytes
+
+        while self.max_bytes is not None and self.n_bytes > self.max_bytes:
+            _, (_, evicted_n_bytes) = self.__items.popitem(last=False)
+            self.n_bytes -= evicted_n_bytes
+            self.evictions += 1
+
+    def clear(self):
+        self.__items.clear()
+        self.n_bytes = 0
+
+    def stats(self) -> dict[str, int | float]:
+        """Returns the counters of this cache, e.g., for logging."""
+        n_requests = self.hits + self.misses
+        return {
+            'items': len(self),
+            'bytes': self.n_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / n_requests if n_requests > 0 else 0.0,
+        }
+
+    def __contains__(self, key: Hashable):
+        return key in self.__items
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __repr__(self):
+        stats = self.stats()
+        return f"EmbeddingsCache({stats['items']} items, {stats['bytes'] / 1024 ** 2:.1f} MiB, " \
+               f"hit rate {stats['hit_rate']:.3f}, {stats['evictions']} evictions)"
@@ -1,39 +1,147 @@
 import glob
+import json
+import os
 from typing import Optional
 
 import torch
 from sklearn.model_selection import train_test_split
-from torch.utils.data import Dataset, DataLoader
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import Dataset
+
+from .embeddings_cache import EmbeddingsCache
+from .embeddings_store import EmbeddingsStore, EmbeddingsStoreView, open_store, read_manifest, merge_views, \
+    store_signature
+
+MULTILINGUAL_LANGUAGES = ['English', 'Dutch', 'French', 'Spanish']
+
+
+def composite_languages(language: str, source='English') -> Optional[list[str]]:
+    """Returns the languages that a composite language is the concatenation of, or None if the language is not
+    composite. The composite languages are Multilingual, XACSfor{target} and any languages joined by '+', e.g.,
+    'English+Dutch'. These match the datasets that are merged in main_translate.py.
+
+    :param language: the language of an EmbeddingsDataset
+    :param source: the source language of XACSfor{target}
+    """
+    if language == 'Multilingual':
+        return MULTILINGUAL_LANGUAGES
+    if language.startswith('XACSfor'):
+        target = language[len('XACSfor'):]
+        return [source, f"{target}Translated", f"{source}to{target}ACS", f"{target}to{source}ACS"]
+    if '+' in language:
+        return language.split('+')
+    return None
+
+
+def embeddings_dir(year: int, language: str, phase='Train', ont_hops: Optional[int] = None, use_vm=True,
+                   use_soft_pos=True, precision='float32') -> str:
+    """Returns the directory of the embeddings of a dataset."""
+    path = f'data/embeddings/{year}-{phase}-{language}'
+    if ont_hops is not None:
+        path += f"_hops-{ont_hops}"
+    if not use_vm:
+        path += f"_no-vm"
+    if not use_soft_pos:
+        path += f"_no-sp"
+    if precision != 'float32':
+        path += f"_{precision}"
+    return path
 
 
 class EmbeddingsDataset(Dataset):
     def __init__(self, year: int, language: str, phase='Train', ont_hops: Optional[int] = None, device=torch.device('cuda'),
-                 empty_ok=False, enable_cache=True, use_vm=True, use_soft_pos=True):
-        self.dir = f'data/embeddings/{year}-{phase}-{language}'
-        if ont_hops is not None:
-            self.dir += f"_hops-{ont_hops}"
-        if not use_vm:
-            self.dir += f"_no-vm"
-        if not use_soft_pos:
-            self.dir += f"_no-sp"
+                 empty_ok=False, enable_cache=True, use_vm=True, use_soft_pos=True, precision='float32',
+                 cache: Optional[EmbeddingsCache] = None):
+        """
+        :param enable_cache: whether loaded items are kept in memory
+        :param cache: the cache to use if enable_cache is True, a cache can be shared with other datasets. If None, a
+                      new cache with the default byte budget is created.
+        """
+        self.year = year
+        self.language = language
+        self.phase = phase
+        self.ont_hops = ont_hops
+        self.use_vm = use_vm
+        self.use_soft_pos = use_soft_pos
+        self.precision = precision
+
+        self.dir = embeddings_dir(year, language, phase, ont_hops, use_vm, use_soft_pos, precision)
+        self.components = composite_languages(language)
+        if self.components is not None:
+            self.__compose(empty_ok)
 
         self.device = device
-        self.length = len(glob.glob(f'{self.dir}/*.pt'))
-        self.cache: dict[int, tuple] = {}
-        self.enable_cache = enable_cache
+        self.manifest: Optional[dict] = read_manifest(self.dir)
+        self.__store: Optional[EmbeddingsStore | EmbeddingsStoreView] = None
+        if self.manifest is not None:
+            self.length = self.manifest['count']
+        elif self.store is not None:
+            self.length = len(self.store)
+        else:
+            self.length = len(glob.glob(f'{self.dir}/*.pt'))
+        self.cache: Optional[EmbeddingsCache] = (cache if cache is not None else EmbeddingsCache()) \
+            if enable_cache else None
+        self.lengths: Optional[list[tuple[int, int, int]]] = None
 
         if not empty_ok and self.length == 0:
             raise ValueError(f"Could not find embeddings at {self.dir}")
 
+    def __compose(self, empty_ok: bool):
+        """Concatenate the embeddings of the component languages into a view, without copying any embeddings. The
+        signatures of the components are stored in the manifest of the view, the view is rebuilt when any of the
+        components was written again."""
+        component_dirs = [embeddings_dir(self.year, component, self.phase, self.ont_hops, self.use_vm,
+                                         self.use_soft_pos, self.precision) for component in self.components]
+
+        # embeddings that were generated from the merged dataset itself are used as they are
+        if EmbeddingsStore.exists(self.dir) or len(glob.glob(f'{self.dir}/*.pt')) > 0:
+            return
+
+        missing = [path for path in component_dirs if open_store(path) is None]
+        if len(missing) > 0:
+            if empty_ok:
+                return
+            raise ValueError(f"Could not find the embeddings of {self.language} at {', '.join(missing)}, generate "
+                             f"(or convert) these first")
+
+        signatures = {path: store_signature(path) for path in component_dirs}
+        manifest = read_manifest(self.dir)
+        if manifest is not None and manifest['config'].get('components') == signatures:
+            return
+
+        first_manifest = read_manifest(component_dirs[0])
+        config = {
+            **(first_manifest['config'] if first_manifest is not None else {}),
+            'language': self.language,
+            'components': signatures,
+        }
+        n_opinions = merge_views(component_dirs, self.dir, config)
+        print(f"Composed {n_opinions} opinions of {', '.join(self.components)} into {self.dir}")
+
+    @property
+    def store(self) -> Optional[EmbeddingsStore | EmbeddingsStoreView]:
+        """The EmbeddingsStore or EmbeddingsStoreView of this dataset, which is opened when it is first used. Returns
+        None if the embeddings are stored as one file per opinion."""
+        if self.__store is None:
+            self.__store = open_store(self.dir)
+        return self.__store
+
     def __getitem__(self, item: int):
-        if item in self.cache:
-            return self.cache[item]
-
-        data: dict = torch.load(f"{self.dir}/{item}.pt", map_location=self.device)
-        label: torch.Tensor = torch.tensor(data['label'], requires_grad=False, device=self.device)
-        embeddings: torch.Tensor = data['embeddings']
-        target_pos: tuple[int, int] = data['target_pos']
-        hops: Optional[torch.Tensor] = data['hops']
+        if self.cache is not None:
+            cached = self.cache.get((self.dir, item))
+            if cached is not None:
+                return cached
+
+        if self.store is not None:
+            embeddings, label_value, target_pos, hops = self.store[item]
+        else:
+            data: dict = torch.load(f"{self.dir}/{item}.pt", map_location=self.device)
+            embeddings: torch.Tensor = data['embeddings']
+            label_value: int = data['label']
+            target_pos: tuple[int, int] = data['target_pos']
+            hops: Optional[torch.Tensor] = data['hops']
+
+        label: torch.Tensor = torch.tensor(label_value, requires_grad=False, device=self.device)
         target_index_start, target_index_end = target_pos
 
         left: torch.Tensor = embeddings[0:target_index_start]
@@ -43,14 +151,58 @@ class EmbeddingsDataset(Dataset):
         result = (
             (left.to(self.device), target.to(self.device), right.to(self.device)),
             label,
-            hops
+            hops.to(self.device) if hops is not None else None
         )
 
-        if self.enable_cache:
-            self.cache[item] = result
+        if self.cache is not None:
+            self.cache.put((self.dir, item), result)
 
         return result
 
+    def get_lengths(self) -> list[tuple[int, int, int]]:
+        """Returns the number of tokens in the left context, target and right context of each opinion. The lengths are
+        read from the manifest if it exists. For directories that are not converted to an EmbeddingsStore, the lengths
+        are read from the embeddings once and cached in the embeddings directory."""
+        if self.lengths is not None:
+            return self.lengths
+        if self.manifest is not None:
+            self.lengths = [tuple(item) for item in self.manifest['lengths']]
+            return self.lengths
+        if self.store is not None:
+            self.lengths = self.store.get_lengths()
+            return self.lengths
+
+        path = f"{self.dir}/lengths.json"
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                lengths = [tuple(item) for item in json.load(f)]
+        else:
+            lengths = []
+            for i in range(self.length):
+                data: dict = torch.load(f"{self.dir}/{i}.pt", map_location='cpu')
+                target_index_start, target_index_end = data['target_pos']
+                n_tokens = len(data['embeddings'])
+                lengths.append(
+                    (target_index_start, target_index_end - target_index_start, n_tokens - target_index_end))
+
+            with open(path, "w") as f:
+                json.dump(lengths, f)
+
+        if len(lengths) != self.length:
+            raise ValueError(f"The cached lengths at {path} do not match the number of embeddings, please remove it")
+
+        self.lengths = lengths
+        return lengths
+
+    def get_labels(self) -> list[int]:
+        """Returns the label of each opinion, preferably without loading any embeddings."""
+        if self.manifest is not None:
+            return self.manifest['labels']
+        if self.store is not None:
+            return self.store.labels.tolist()
+
+        return [torch.load(f"{self.dir}/{i}.pt", map_location='cpu')['label'] for i in range(self.length)]
+
     def __len__(self):
         return self.length
 
@@ -60,11 +212,32 @@ class EmbeddingsDataset(Dataset):
 
 def train_validation_split(dataset: EmbeddingsDataset, validation_size=0.2, seed: Optional[float] = None):
     # create list of all labels
-    loader = DataLoader(dataset, collate_fn=lambda batch: batch)
-    labels: list[int] = [data[0][1].item() for data in loader]
+    labels = dataset.get_labels()
 
     # create stratified train-validation split
     train_idx, validation_idx = train_test_split(
         range(len(dataset)), test_size=validation_size, shuffle=True, stratify=labels, random_state=seed)
 
     return train_idx, validation_idx
+
+
+def pad_batch(batch: list[tuple]):
+    """Pad a list of items from an EmbeddingsDataset into the inputs of LCRRotHopPlusPlus.forward_batch."""
+    segments = list(zip(*[embeddings for embeddings, _, _ in batch]))
+    embeddings = [pad_sequence(list(segment), batch_first=True) for segment in segments]
+    lengths = [torch.tensor([len(item) for item in segment], device=padded.device) for segment, padded in
+               zip(segments, embeddings)]
+
+    hops: Optional[tuple[torch.Tensor, ...]] = None
+    if all(item_hops is not None for _, _, item_hops in batch):
+        split_hops = [item_hops.split([len(x) for x in item_embeddings]) for item_embeddings, _, item_hops in batch]
+        hops = tuple(pad_sequence(list(segment), batch_first=True) for segment in zip(*split_hops))
+
+    return (*embeddings, *lengths, hops)
+
+
+def collate_padded(batch: list[tuple]):
+    """Collate function for a DataLoader over an EmbeddingsDataset, it returns the padded inputs for
+    LCRRotHopPlusPlus.forward_batch and a tensor with the labels."""
+    labels = torch.stack([label for _, label, _ in batch])
+    return pad_batch(batch), labels
@@ -0,0 +1,450 @@
+import glob
+import hashlib
+import json
+import os
+import shutil
+from typing import Optional
+
+import torch
+
+EMBEDDINGS_FILE = "embeddings.bin"
+INDEX_FILE = "index.pt"
+MANIFEST_FILE = "manifest.json"
+VIEW_FILE = "view.json"
+
+PRECISIONS = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'int8': torch.int8,
+}
+"""The supported storage types of the embeddings, int8 embeddings are scaled per row (token)"""
+
+
+def quantize(embeddings: torch.Tensor, precision: str) -> tuple[torch.Tensor, Optional[torch.Tensor]]:
+    """Convert float embeddings to the given precision. Returns the converted embeddings and, for int8, the scale of
+    each row."""
+    if precision == 'int8':
+        scales = embeddings.abs().amax(dim=1) / 127
+        scales = torch.where(scales > 0, scales, torch.ones_like(scales))
+        values = torch.round(embeddings / scales.unsqueeze(1)).clamp(-127, 127).to(torch.int8)
+        return values, scales
+
+    return embeddings.to(PRECISIONS[precision]), None
+
+
+def dequantize(values: torch.Tensor, scales: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """Convert embeddings that are returned by quantize back to float32."""
+    if scales is not None:
+        return values.float() * scales.unsqueeze(1)
+
+    return values.float()
+
+
+class EmbeddingsStoreWriter:
+    """Writes the embeddings of all opinions of a dataset into a single contiguous file of rows, together with an index
+    that contains the offsets, labels, target positions and hops of each opinion. The rows are stored as float32,
+    float16 or int8 depending on the precision. The files are written to a temporary location and moved into place by
+    close(), such that an interrupted run does not leave a partial store.
+
+    Next to the store, a small JSON manifest is written with the labels, segment lengths and sentence ids of all
+    opinions, and the configuration that was used to generate the embeddings. The manifest can be read without
+    touching the embeddings."""
+
+    def __init__(self, path: str, embedding_size=768, precision='float32', config: Optional[dict] = None):
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision \"{precision}\", expected one of {', '.join(PRECISIONS)}")
+
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.embedding_size = embedding_size
+        self.precision = precision
+        self.config = config if config is not None else {}
+
+        self.__offsets: list[int] = [0]
+        self.__labels: list[int] = []
+        self.__target_pos: list[tuple[int, int]] = []
+        self.__hops: list[torch.Tensor] = []
+        self.__scales: list[torch.Tensor] = []
+        self.__sentence_ids: list[Optional[str]] = []
+        self.__has_hops: Optional[bool] = None
+
+        self.__file = open(f"{path}/{EMBEDDINGS_FILE}.tmp", "wb")
+
+    def append(self, embeddings: torch.Tensor, label: int, target_pos: tuple[int, int],
+               hops: Optional[torch.Tensor] = None, sentence_id: Optional[str] = None):
+        """
+        :param embeddings: [n x embedding_size] the embeddings of each token of the sentence
+        :param label: the label of the opinion
+        :param target_pos: the start and end index of the target
+        :param hops: [n] optional vector with the number of hops for each token
+        :param sentence_id: optional id of the sentence that contains the opinion
+        """
+        n_tokens, embedding_size = embeddings.size()
+        if embedding_size != self.embedding_size:
+            raise ValueError(f"Expected embeddings of size {self.embedding_size}, got {embedding_size}")
+        if self.__has_hops is None:
+            self.__has_hops = hops is not None
+        elif self.__has_hops != (hops is not None):
+            raise ValueError("Either all or none of the opinions in a store should have hops")
+
+        values, scales = quantize(embeddings.detach().to('cpu', torch.float32), self.precision)
+        self.__file.write(values.contiguous().numpy().tobytes())
+        if scales is not None:
+            self.__scales.append(scales)
+        self.__offsets.append(self.__offsets[-1] + n_tokens)
+        self.__labels.append(label)
+        self.__target_pos.append((int(target_pos[0]), int(target_pos[1])))
+        self.__sentence_ids.append(sentence_id)
+        if hops is not None:
+            self.__hops.append(hops.detach().to('cpu', torch.long))
+
+    def __len__(self):
+        return len(self.__labels)
+
+    def close(self):
+        self.__file.close()
+
+        index = {
+            'embedding_size': self.embedding_size,
+            'precision': self.precision,
+            'scales': torch.cat(self.__scales) if len(self.__scales) > 0 else None,
+            'offsets': torch.tensor(self.__offsets, dtype=torch.long),
+            'labels': torch.tensor(self.__labels, dtype=torch.long),
+            'target_pos': torch.tensor(self.__target_pos, dtype=torch.long).view(-1, 2),
+            'hops': torch.cat(self.__hops) if self.__has_hops else None,
+        }
+        torch.save(index, f"{self.path}/{INDEX_FILE}.tmp")
+
+        manifest = {
+            'count': len(self),
+            'labels': self.__labels,
+            'lengths': [
+                (target_start, target_end - target_start, (end - start) - target_end) for
+                (target_start, target_end), start, end in
+                zip(self.__target_pos, self.__offsets[:-1], self.__offsets[1:])
+            ],
+            'sentence_ids': self.__sentence_ids,
+            'config': {**self.config, 'precision': self.precision, 'embedding_size': self.embedding_size},
+        }
+        with open(f"{self.path}/{MANIFEST_FILE}.tmp", "w") as f:
+            json.dump(manifest, f)
+
+        os.replace(f"{self.path}/{EMBEDDINGS_FILE}.tmp", f"{self.path}/{EMBEDDINGS_FILE}")
+        os.replace(f"{self.path}/{INDEX_FILE}.tmp", f"{self.path}/{INDEX_FILE}")
+        os.replace(f"{self.path}/{MANIFEST_FILE}.tmp", f"{self.path}/{MANIFEST_FILE}")
+        # the store replaces a view that was written to the same directory
+        if os.path.isfile(f"{self.path}/{VIEW_FILE}"):
+            os.remove(f"{self.path}/{VIEW_FILE}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__file.close()
+
+
+class EmbeddingsStore:
+    """Read-only view of a store written by EmbeddingsStoreWriter. The embeddings file is memory-mapped, float32
+    embeddings are returned as views into the mapping, so no data is copied until it is moved to another device.
+    Embeddings with a reduced precision are converted back to float32 when they are read."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+        index: dict = torch.load(f"{path}/{INDEX_FILE}", map_location='cpu')
+        self.embedding_size: int = index['embedding_size']
+        self.precision: str = index.get('precision', 'float32')
+        self.scales: Optional[torch.Tensor] = index.get('scales')
+        self.offsets: torch.Tensor = index['offsets']
+        self.labels: torch.Tensor = index['labels']
+        self.target_pos: torch.Tensor = index['target_pos']
+        self.hops: Optional[torch.Tensor] = index['hops']
+
+        n_values = int(self.offsets[-1]) * self.embedding_size
+        dtype = PRECISIONS[self.precision]
+        if n_values == 0:
+            self.embeddings = torch.empty(0, self.embedding_size, dtype=dtype)
+        else:
+            self.embeddings = torch.from_file(f"{path}/{EMBEDDINGS_FILE}", shared=False, size=n_values,
+                                              dtype=dtype).view(-1, self.embedding_size)
+
+    @staticmethod
+    def exists(path: str):
+        return os.path.isfile(f"{path}/{INDEX_FILE}") and os.path.isfile(f"{path}/{EMBEDDINGS_FILE}")
+
+    def get_lengths(self) -> list[tuple[int, int, int]]:
+        """Returns the number of tokens in the left context, target and right context of each opinion."""
+        n_tokens = self.offsets[1:] - self.offsets[:-1]
+        target_start, target_end = self.target_pos[:, 0], self.target_pos[:, 1]
+        lengths = torch.stack([target_start, target_end - target_start, n_tokens - target_end], dim=1)
+        return [tuple(item) for item in lengths.tolist()]
+
+    def __getitem__(self, item: int) -> tuple[torch.Tensor, int, tuple[int, int], Optional[torch.Tensor]]:
+        start, end = int(self.offsets[item]), int(self.offsets[item + 1])
+        target_index_start, target_index_end = self.target_pos[item].tolist()
+        hops = self.hops[start:end].clone() if self.hops is not None else None
+
+        embeddings = self.embeddings[start:end]
+        if self.precision != 'float32':
+            embeddings = dequantize(embeddings, self.scales[start:end] if self.scales is not None else None)
+
+        return embeddings, int(self.labels[item]), (target_index_start, target_index_end), hops
+
+    def __len__(self):
+        return len(self.labels)
+
+
+class EmbeddingsStoreView:
+    """Read-only view of rows of other EmbeddingsStores, which is written by write_view. The view has the same
+    interface as an EmbeddingsStore, but it does not contain any embeddings itself. The labels are stored in the view,
+    as the rows may be shared by opinions with different labels."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+        with open(f"{path}/{VIEW_FILE}", "r") as f:
+            view: dict = json.load(f)
+        # the sources are relative to the view
+        self.sources: list[str] = [os.path.normpath(os.path.join(path, source)) for source in view['sources']]
+        self.rows: list[tuple[int, int]] = [(source, row) for source, row in view['rows']]
+        self.labels: torch.Tensor = torch.tensor(view['labels'], dtype=torch.long)
+        self.__stores: dict[int, EmbeddingsStore] = {}
+
+        first = self.__store(self.rows[0][0]) if len(self.rows) > 0 else None
+        self.embedding_size: int = first.embedding_size if first is not None else view.get('embedding_size', 768)
+        self.precision: str = first.precision if first is not None else view.get('precision', 'float32')
+
+    @staticmethod
+    def exists(path: str):
+        return os.path.isfile(f"{path}/{VIEW_FILE}")
+
+    def __store(self, source: int) -> EmbeddingsStore:
+        if source not in self.__stores:
+            self.__stores[source] = EmbeddingsStore(self.sources[source])
+        return self.__stores[source]
+
+    def get_lengths(self) -> list[tuple[int, int, int]]:
+        """Returns the number of tokens in the left context, target and right context of each opinion."""
+        lengths: dict[int, list[tuple[int, int, int]]] = {}
+        for source, _ in self.rows:
+            if source not in lengths:
+                lengths[source] = self.__store(source).get_lengths()
+        return [lengths[source][row] for source, row in self.rows]
+
+    def __getitem__(self, item: int) -> tuple[torch.Tensor, int, tuple[int, int], Optional[torch.Tensor]]:
+        source, row = self.rows[item]
+        embeddings, _, target_pos, hops = self.__store(source)[row]
+        return embeddings, int(self.labels[item]), target_pos, hops
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def write_view(path: str, rows: list[tuple[str, int]], labels: list[int], sentence_ids: Optional[list[str]] = None,
+               config: Optional[dict] = None):
+    """Write an EmbeddingsStoreView and its manifest to path.
+
+    :param rows: the path of the store and the index in that store of each opinion
+    :param labels: the label of each opinion
+    :param sentence_ids: the optional sentence id of each opinion
+    :param config: the configuration that is stored in the manifest
+    """
+    os.makedirs(path, exist_ok=True)
+    sources: dict[str, int] = {}
+    view_rows: list[tuple[int, int]] = []
+    for source, row in rows:
+        source = os.path.normpath(source)
+        if source not in sources:
+            sources[source] = len(sources)
+        view_rows.append((sources[source], row))
+
+    view = {
+        'sources': [os.path.relpath(source, path) for source in sources],
+        'rows': view_rows,
+        'labels': labels,
+    }
+    with open(f"{path}/{VIEW_FILE}.tmp", "w") as f:
+        json.dump(view, f)
+    os.replace(f"{path}/{VIEW_FILE}.tmp", f"{path}/{VIEW_FILE}")
+
+    store = EmbeddingsStoreView(path)
+    manifest = {
+        'count': len(view_rows),
+        'labels': labels,
+        'lengths': store.get_lengths(),
+        'sentence_ids': sentence_ids if sentence_ids is not None else [None] * len(view_rows),
+        'config': {**(config if config is not None else {}), 'precision': store.precision,
+                   'embedding_size': store.embedding_size},
+    }
+    with open(f"{path}/{MANIFEST_FILE}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}/{MANIFEST_FILE}.tmp", f"{path}/{MANIFEST_FILE}")
+
+    # the view replaces a store that was written to the same directory
+    for file in (EMBEDDINGS_FILE, INDEX_FILE):
+        if os.path.isfile(f"{path}/{file}"):
+            os.remove(f"{path}/{file}")
+
+
+def open_store(path: str) -> Optional[EmbeddingsStore | EmbeddingsStoreView]:
+    """Open the EmbeddingsStore or EmbeddingsStoreView at path, returns None if there is neither."""
+    if EmbeddingsStoreView.exists(path):
+        return EmbeddingsStoreView(path)
+    if EmbeddingsStore.exists(path):
+        return EmbeddingsStore(path)
+    return None
+
+
+def store_signature(path: str) -> str:
+    """Returns a hash of the index, manifest and view of the store at path, which changes whenever the store is written
+    again with different contents."""
+    signature = hashlib.sha256()
+    for file in (INDEX_FILE, MANIFEST_FILE, VIEW_FILE):
+        if os.path.isfile(f"{path}/{file}"):
+            with open(f"{path}/{file}", "rb") as f:
+                signature.update(file.encode('utf-8'))
+                signature.update(f.read())
+    return signature.hexdigest()
+
+
+def read_manifest(path: str) -> Optional[dict]:
+    """Read the manifest of the store at path, returns None if the store has no manifest."""
+    if not os.path.isfile(f"{path}/{MANIFEST_FILE}"):
+        return None
+
+    with open(f"{path}/{MANIFEST_FILE}", "r") as f:
+        return json.load(f)
+
+
+def convert_embeddings_dir(path: str, remove_legacy=True) -> int:
+    """Convert a directory with one .pt file per opinion, as written by earlier versions of main_embed.py, into an
+    EmbeddingsStore. Returns the number of converted opinions."""
+    n = len(glob.glob(f"{path}/*.pt"))
+
+    with EmbeddingsStoreWriter(path) as writer:
+        for i in range(n):
+            data: dict = torch.load(f"{path}/{i}.pt", map_location='cpu')
+            writer.append(data['embeddings'], data['label'], data['target_pos'], data['hops'])
+
+    if remove_legacy:
+        for i in range(n):
+            os.remove(f"{path}/{i}.pt")
+        if os.path.isfile(f"{path}/lengths.json"):
+            os.remove(f"{path}/lengths.json")
+
+    return n
+
+
+def convert_store_precision(src_path: str, dst_path: str, precision: str) -> int:
+    """Write a copy of the EmbeddingsStore at src_path with the given precision to dst_path. Returns the number of
+    converted opinions."""
+    store = open_store(src_path)
+    manifest = read_manifest(src_path)
+    config = manifest['config'] if manifest is not None else None
+    sentence_ids = manifest['sentence_ids'] if manifest is not None else [None] * len(store)
+
+    with EmbeddingsStoreWriter(dst_path, embedding_size=store.embedding_size, precision=precision,
+                               config=config) as writer:
+        for i in range(len(store)):
+            writer.append(*store[i], sentence_id=sentence_ids[i])
+
+    return len(store)
+
+
+def merge_stores(src_paths: list[str], dst_path: str) -> int:
+    """Concatenate the EmbeddingsStores at src_paths into a single store at dst_path, in the given order. The rows are
+    copied without conversion, so all stores should have the same precision and embedding size. Returns the number of
+    opinions in the merged store."""
+    stores = [EmbeddingsStore(path) for path in src_paths]
+    manifests = [read_manifest(path) for path in src_paths]
+    if len(stores) == 0:
+        raise ValueError("Expected at least one store to merge")
+
+    embedding_size, precision = stores[0].embedding_size, stores[0].precision
+    for store in stores:
+        if store.embedding_size != embedding_size or store.precision != precision:
+            raise ValueError(f"Cannot merge a store of {store.precision} embeddings of size {store.embedding_size} "
+                             f"into a store of {precision} embeddings of size {embedding_size}")
+    has_hops = stores[0].hops is not None
+    if any((store.hops is not None) != has_hops for store in stores):
+        raise ValueError("Either all or none of the stores should have hops")
+
+    os.makedirs(dst_path, exist_ok=True)
+    with open(f"{dst_path}/{EMBEDDINGS_FILE}.tmp", "wb") as dst:
+        for path in src_paths:
+            with open(f"{path}/{EMBEDDINGS_FILE}", "rb") as src:
+                shutil.copyfileobj(src, dst)
+
+    offsets = [torch.zeros(1, dtype=torch.long)]
+    n_rows = 0
+    for store in stores:
+        offsets.append(store.offsets[1:] + n_rows)
+        n_rows += int(store.offsets[-1])
+
+    index = {
+        'embedding_size': embedding_size,
+        'precision': precision,
+        'scales': torch.cat([store.scales for store in stores]) if stores[0].scales is not None else None,
+        'offsets': torch.cat(offsets),
+        'labels': torch.cat([store.labels for store in stores]),
+        'target_pos': torch.cat([store.target_pos for store in stores]),
+        'hops': torch.cat([store.hops for store in stores]) if has_hops else None,
+    }
+    torch.save(index, f"{dst_path}/{INDEX_FILE}.tmp")
+
+    manifest = {
+        'count': sum(len(store) for store in stores),
+        'labels': [label for store in stores for label in store.labels.tolist()],
+        'lengths': [lengths for store in stores for lengths in store.get_lengths()],
+        'sentence_ids': [
+            sentence_id for store, manifest in zip(stores, manifests) for sentence_id in
+            (manifest['sentence_ids'] if manifest is not None else [None] * len(store))
+        ],
+        'config': manifests[0]['config'] if manifests[0] is not None else
+        {'precision': precision, 'embedding_size': embedding_size},
+    }
+    with open(f"{dst_path}/{MANIFEST_FILE}.tmp", "w") as f:
+        json.dump(manifest, f)
+
+    os.replace(f"{dst_path}/{EMBEDDINGS_FILE}.tmp", f"{dst_path}/{EMBEDDINGS_FILE}")
+    os.replace(f"{dst_path}/{INDEX_FILE}.tmp", f"{dst_path}/{INDEX_FILE}")
+    os.replace(f"{dst_path}/{MANIFEST_FILE}.tmp", f"{dst_path}/{MANIFEST_FILE}")
+    # the store replaces a view that was written to the same directory
+    if os.path.isfile(f"{dst_path}/{VIEW_FILE}"):
+        os.remove(f"{dst_path}/{VIEW_FILE}")
+
+    return manifest['count']
+
+
+def merge_views(src_paths: list[str], dst_path: str, config: Optional[dict] = None) -> int:
+    """Concatenate the EmbeddingsStoreViews or EmbeddingsStores at src_paths into a single view at dst_path, in the
+    given order, without copying any embeddings. The rows of a source view are referred to directly, so the source
+    views can be removed afterwards, whereas the source stores should be kept. Returns the number of opinions in the
+    merged view.
+
+    :param config: the configuration that is stored in the manifest, defaults to that of the first source
+    """
+    rows: list[tuple[str, int]] = []
+    labels: list[int] = []
+    sentence_ids: list[Optional[str]] = []
+
+    for path in src_paths:
+        store = open_store(path)
+        if store is None:
+            raise ValueError(f"Could not find an embeddings store at {path}")
+
+        manifest = read_manifest(path)
+        if isinstance(store, EmbeddingsStoreView):
+            rows += [(store.sources[source], row) for source, row in store.rows]
+        else:
+            rows += [(path, row) for row in range(len(store))]
+        labels += store.labels.tolist()
+        sentence_ids += manifest['sentence_ids'] if manifest is not None else [None] * len(store)
+        if config is None and manifest is not None:
+            config = manifest['config']
+
+    write_view(dst_path, rows, labels, sentence_ids, config)
+    return len(rows)